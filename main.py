@@ -3,94 +3,539 @@ from mpi4py import MPI
 import numpy as np
 import argparse
 import time
-import math
+import os
+import json
+import shutil
+import hashlib
+import resource
+import tempfile
+from collections import namedtuple
 
-# from solutions.bruteforce import bruteforce
-# from solutions.spgemm import coo_spgemm, csr_spgemm
-# from solutions.cannon import cannon_matrix_multiply
-# from solutions.blocked import blocked_matrix_multiply
+# from solutions.bruteforce_sol import bruteforce
+# from solutions.spgemm_sol import coo_spgemm, csr_spgemm, stream_spgemm, dynamic_spgemm, spsumma_spgemm, gram_spgemm
+# from solutions.cannon_sol import cannon_matrix_multiply, cannon_matrix_multiply_overlap
+# from solutions.blocked_sol import blocked_matrix_multiply, blocked_matrix_multiply_shared, summa_matrix_multiply
+# from solutions.bitpacked_sol import bitpacked_multiply, blocked_bitpacked_multiply
 
 from problems.bruteforce import bruteforce
-from problems.spgemm import coo_spgemm, csr_spgemm
-from problems.cannon import cannon_matrix_multiply
-from problems.blocked import blocked_matrix_multiply
-
-def read_sparse_matrix_file(file):
-    with open(file, 'r') as f:
-        edge_list = []
-        spgemm_result = []
-        num_nodes, src_node, num_edges, result_num_nnz = 0, 0, 0, 0
-        for idx, line in enumerate(f):
-            if idx == 0:
-                params = line.strip().split(' ')
-                num_nodes = int(params[0])
-                src_node = int(params[1])
-            elif idx == 1:
-                num_edges = int(line.strip())
-            elif idx > 1 and idx < 2 + num_edges:
-                edge = line.strip().split(' ')
-                u, v = int(edge[0]), int(edge[1])
-                edge_list.append([u, v])
-            elif idx == 2 + num_edges:
-                # num non-zero entries in A*A transpose
-                result_num_nnz = int(line.strip())
-            elif idx > 2 + num_edges and idx <= 2 + num_edges + result_num_nnz:
-                nnzs = line.strip().split(' ')
-                i, j, w = int(nnzs[0]), int(nnzs[1]), int(nnzs[2])
-                spgemm_result.append([i, j, w])
-    return num_nodes, src_node, num_edges, edge_list, spgemm_result
-
-
-def convert_to_matrix(num_nodes, edge_list):
+from problems.spgemm import coo_spgemm, csr_spgemm, stream_spgemm, dynamic_spgemm, spsumma_spgemm, gram_spgemm
+from problems.cannon import cannon_matrix_multiply, cannon_matrix_multiply_overlap
+from problems.blocked import blocked_matrix_multiply, blocked_matrix_multiply_shared, summa_matrix_multiply
+from problems.bitpacked import bitpacked_multiply, blocked_bitpacked_multiply
+
+# Typed containers for parsed input. rows/cols are int32 (node ids), vals are int64.
+COOMatrix = namedtuple('COOMatrix', ['rows', 'cols', 'vals'])
+SparseMatrixFile = namedtuple('SparseMatrixFile', ['num_nodes', 'src_node', 'num_edges', 'edges', 'spgemm_result'])
+
+# Bump when the on-disk cache layout changes so stale sidecars are rebuilt
+CACHE_VERSION = 1
+
+
+def read_sparse_matrix_file(file, as_lists=False):
     """
+    Parses an input file in a single pass. The header line is read on its own, the rest of the
+    file is tokenized by numpy in C, then the edge block and the expected-result block are sliced
+    out of the token array.
+
     Args:
-        edge_list: list of non-zero matrix entries
+        file: path to the input file
+        as_lists: if True, return the old (num_nodes, src_node, num_edges, edge_list, spgemm_result)
+                  tuple of python lists instead of arrays
+
+    Returns:
+        SparseMatrixFile whose edges (weights all 1) and spgemm_result are COOMatrix arrays
+    """
+    with open(file, 'rb') as f:
+        # The first line may carry more than the node count and source node, only those two are read
+        num_nodes, src_node = (int(x) for x in f.readline().split()[:2])
+        tokens = np.fromstring(f.read(), dtype=np.int64, sep=' ')
+
+    num_edges = int(tokens[0])
+    edge_end = 1 + 2 * num_edges
+    edge_block = tokens[1:edge_end].reshape(num_edges, 2)
+
+    # num non-zero entries in A*A transpose
+    result_num_nnz = int(tokens[edge_end]) if tokens.size > edge_end else 0
+    result_block = tokens[edge_end + 1:edge_end + 1 + 3 * result_num_nnz].reshape(result_num_nnz, 3)
+
+    edges = COOMatrix(edge_block[:, 0].astype(np.int32),
+                      edge_block[:, 1].astype(np.int32),
+                      np.ones(num_edges, dtype=np.int64))
+    spgemm_result = COOMatrix(result_block[:, 0].astype(np.int32),
+                              result_block[:, 1].astype(np.int32),
+                              np.ascontiguousarray(result_block[:, 2]))
+
+    if as_lists:
+        edge_list = np.column_stack((edges.rows, edges.cols)).tolist()
+        return num_nodes, src_node, num_edges, edge_list, coo_to_list(spgemm_result)
+    return SparseMatrixFile(num_nodes, src_node, num_edges, edges, spgemm_result)
+
+
+def sort_coo(coo):
+    # Row-major order, the same order the old driver produced with list.sort(key=(row, col))
+    order = np.lexsort((coo.cols, coo.rows))
+    return COOMatrix(coo.rows[order], coo.cols[order], coo.vals[order])
+
+
+def transpose_coo(coo):
+    return sort_coo(COOMatrix(coo.cols, coo.rows, coo.vals))
+
+
+def coo_array(coo):
+    # COOMatrix as one (nnz x 3) int64 array of [i, j, w] rows, the layout the spgemm results use
+    return np.column_stack((coo.rows, coo.cols, coo.vals)).astype(np.int64, copy=False)
+
+
+def coo_to_list(coo):
+    # Compatibility with the list-of-[i, j, w] format used by coo_spgemm
+    return coo_array(coo).tolist()
+
+
+def csr_to_coo(indptr, indices, data, first_row=0):
+    # Expands CSR arrays (rows first_row ... first_row + len(indptr) - 2) back into a COOMatrix
+    rows = np.repeat(np.arange(first_row, first_row + len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+    return COOMatrix(rows, np.asarray(indices, dtype=np.int32), np.asarray(data, dtype=np.int64))
+
+
+def restrict_coo(coo, mask, num_cols):
+    # Keeps only the entries of coo at (row, col) positions that are also present in mask
+    keys = coo.rows.astype(np.int64) * num_cols + coo.cols
+    mask_keys = mask.rows.astype(np.int64) * num_cols + mask.cols
+    keep = np.isin(keys, mask_keys)
+    return COOMatrix(coo.rows[keep], coo.cols[keep], coo.vals[keep])
+
+
+def file_digest(file):
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 22), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_path(file):
+    # Sidecar directory next to the input, e.g. tests/input2.txt -> tests/input2.txt.cache/
+    return file + '.cache'
+
+
+def write_matrix_cache(file, parsed):
+    """
+    Saves a parsed input as a directory of .npy files so later runs can memory-map it.
+    The directory is built under a temporary name and renamed into place, so a run that
+    dies halfway never leaves a half-written cache behind.
+    """
+    stat = os.stat(file)
+    meta = {
+        'version': CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'digest': file_digest(file),
+        'num_nodes': parsed.num_nodes,
+        'src_node': parsed.src_node,
+        'num_edges': parsed.num_edges,
+    }
+    target = cache_path(file)
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(target) + '.', dir=os.path.dirname(os.path.abspath(file)))
+    try:
+        np.save(os.path.join(tmp, 'edge_rows.npy'), parsed.edges.rows)
+        np.save(os.path.join(tmp, 'edge_cols.npy'), parsed.edges.cols)
+        np.save(os.path.join(tmp, 'result_rows.npy'), parsed.spgemm_result.rows)
+        np.save(os.path.join(tmp, 'result_cols.npy'), parsed.spgemm_result.cols)
+        np.save(os.path.join(tmp, 'result_vals.npy'), parsed.spgemm_result.vals)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp, target)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def read_matrix_cache(file):
+    """
+    Returns the cached SparseMatrixFile for file, or None if there is no valid cache.
+
+    Invalidation rule: the cache is used when the input's size and mtime match the values
+    recorded at write time. If only the mtime changed (e.g. after a fresh checkout), the
+    content digest is recomputed and the cache is still used when it matches.
+    """
+    target = cache_path(file)
+    try:
+        with open(os.path.join(target, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    stat = os.stat(file)
+    if meta.get('version') != CACHE_VERSION or meta['size'] != stat.st_size:
+        return None
+    if meta['mtime_ns'] != stat.st_mtime_ns:
+        if meta['digest'] != file_digest(file):
+            return None
+        meta['mtime_ns'] = stat.st_mtime_ns
+        try:
+            with open(os.path.join(target, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+        except OSError:
+            pass
+
+    def load(name):
+        return np.load(os.path.join(target, name + '.npy'), mmap_mode='r')
+
+    try:
+        edge_rows = load('edge_rows')
+        edges = COOMatrix(edge_rows, load('edge_cols'), np.ones(edge_rows.shape[0], dtype=np.int64))
+        spgemm_result = COOMatrix(load('result_rows'), load('result_cols'), load('result_vals'))
+    except (OSError, ValueError):
+        return None
+    return SparseMatrixFile(meta['num_nodes'], meta['src_node'], meta['num_edges'], edges, spgemm_result)
+
+
+def load_sparse_matrix_file(file, use_cache=True):
+    """
+    Same result as read_sparse_matrix_file, but backed by a binary sidecar cache.
+    The first run parses the text file and writes the cache, later runs memory-map it.
+    """
+    if use_cache:
+        parsed = read_matrix_cache(file)
+        if parsed is not None:
+            return parsed
+
+    parsed = read_sparse_matrix_file(file)
+    if use_cache:
+        try:
+            write_matrix_cache(file, parsed)
+        except OSError as e:
+            # A read-only tests/ directory should not stop the run
+            print(f"Could not write matrix cache for {file}: {e}")
+    return parsed
+
+
+def row_partition(num_rows, size):
+    # Row bounds of each rank's block: rank r owns rows [bounds[r], bounds[r + 1]).
+    # Same split as distribute_coo, the first (num_rows % size) ranks get one extra row.
+    counts = np.full(size, num_rows // size, dtype=np.int64)
+    counts[:num_rows % size] += 1
+    bounds = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    return bounds
+
+
+def row_work(rows, cols, num_rows, b_row_nnz=None):
+    """
+    Estimated spgemm work of every row of A, from A's entries (rows, cols).
+
+    Without b_row_nnz this is nnz per row. With b_row_nnz (nnz of every row of B) it is the
+    number of partial products a_ik * b_kj each row generates, i.e. sum over k of nnz(B row k).
+    """
+    if b_row_nnz is None:
+        return np.bincount(rows, minlength=num_rows).astype(np.int64)
+    return np.bincount(rows, weights=b_row_nnz[cols], minlength=num_rows).astype(np.int64)
+
+
+def balanced_row_partition(work, size):
+    # Contiguous row blocks with about the same total work each, same bounds layout as row_partition
+    prefix = np.zeros(len(work) + 1, dtype=np.int64)
+    np.cumsum(work, out=prefix[1:])
+    targets = prefix[-1] * np.arange(1, size) / size
+    bounds = np.empty(size + 1, dtype=np.int64)
+    bounds[0], bounds[-1] = 0, len(work)
+    bounds[1:-1] = np.searchsorted(prefix, targets, side='left')
+    return bounds
+
+
+def imbalance_factor(work, bounds):
+    # max / mean of the work assigned to each rank, 1.0 is perfectly balanced
+    prefix = np.zeros(len(work) + 1, dtype=np.int64)
+    np.cumsum(work, out=prefix[1:])
+    per_rank = np.diff(prefix[bounds])
+    mean = per_rank.mean()
+    return float(per_rank.max() / mean) if mean > 0 else 1.0
+
+
+def plan_row_partition(method, num_rows, size, nnz_work, flops_work):
+    """
+    Args:
+        method: 'rows' (equal number of rows), 'nnz' (equal nnz of A) or 'flops' (equal partial products)
+        nnz_work, flops_work: row_work estimates for every row of A
+
+    Returns:
+        (bounds, imbalance) where imbalance is measured with the flops estimate whatever the method,
+        so the methods can be compared with each other
+    """
+    if method == 'rows':
+        bounds = row_partition(num_rows, size)
+    elif method == 'nnz':
+        bounds = balanced_row_partition(nnz_work, size)
+    elif method == 'flops':
+        bounds = balanced_row_partition(flops_work, size)
+    else:
+        raise ValueError(f"Unknown row partition method: {method}")
+    return bounds, imbalance_factor(flops_work, bounds)
+
+
+def exchange_coo(coo, owners, comm):
+    """
+    Sends every entry of coo to the rank in owners (one destination per entry) with a typed
+    Alltoallv per array, and returns the entries this rank received.
+    """
+    size = comm.Get_size()
+    order = np.argsort(owners, kind='stable')
+    send_counts = np.bincount(owners, minlength=size).astype(np.int64)
+    recv_counts = np.empty(size, dtype=np.int64)
+    comm.Alltoall(send_counts, recv_counts)
+
+    send_displs = np.zeros(size, dtype=np.int64)
+    recv_displs = np.zeros(size, dtype=np.int64)
+    np.cumsum(send_counts[:-1], out=send_displs[1:])
+    np.cumsum(recv_counts[:-1], out=recv_displs[1:])
+
+    received = []
+    for arr in coo:
+        sendbuf = np.ascontiguousarray(arr[order])
+        recvbuf = np.empty(int(recv_counts.sum()), dtype=sendbuf.dtype)
+        comm.Alltoallv([sendbuf, (send_counts, send_displs)], [recvbuf, (recv_counts, recv_displs)])
+        received.append(recvbuf)
+    return COOMatrix(*received)
+
+
+def read_file_range(fh, start, stop, collective=False):
+    buf = np.empty(max(stop - start, 0), dtype=np.uint8)
+    if collective:
+        fh.Read_at_all(start, buf)
+    else:
+        fh.Read_at(start, buf)
+    return buf.tobytes()
+
+
+def parallel_read_sparse_matrix_file(file, comm, partition='rows', transpose=True):
+    """
+    MPI-IO version of read_sparse_matrix_file. Every rank reads an equal byte range of the
+    file, parses the lines that start inside its range, and then the entries are moved to the
+    rank owning their row (see plan_row_partition) with Alltoallv. No rank ever holds the whole file.
+
+    Returns:
+        (num_nodes, src_node, num_edges, bounds, local_A, local_A_transpose, local_result), where rank r
+        owns rows [bounds[r], bounds[r + 1]) and the local matrices are COOMatrix arrays holding only this rank's rows, sorted by (row, col).
+        The imbalance factor of the chosen partition is printed on rank 0. With transpose=False,
+        local_A_transpose is None.
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    fh = MPI.File.Open(comm, file, MPI.MODE_RDONLY)
+    file_size = fh.Get_size()
+
+    # The two header lines are tiny, every rank reads them itself
+    header = b''
+    while header.count(b'\n') < 2 and len(header) < file_size:
+        header += read_file_range(fh, len(header), min(len(header) + 256, file_size))
+    params = header.split(b'\n')
+    num_nodes, src_node = (int(x) for x in params[0].split()[:2])
+    num_edges = int(params[1])
+
+    # A rank owns the lines whose first byte falls in [lo, hi). Reading one byte before lo tells us
+    # if a line starts exactly at lo, and a little slack after hi lets us finish the last line.
+    chunk = max(-(-file_size // size), 1)
+    lo, hi = min(rank * chunk, file_size), min((rank + 1) * chunk, file_size)
+    read_lo = max(lo - 1, 0)
+    read_hi = min(hi + 256, file_size)
+    buf = read_file_range(fh, read_lo, read_hi, collective=True)
+    first = 0 if rank == 0 else buf.find(b'\n') + 1
+    if lo == hi or (rank != 0 and first == 0) or first > hi - read_lo:
+        # No line starts inside this rank's byte range
+        first = last = 0
+    else:
+        last = buf.find(b'\n', hi - 1 - read_lo)
+        while last == -1 and read_hi < file_size:
+            # Line longer than the slack, keep reading until it ends
+            more_hi = min(read_hi + 4096, file_size)
+            buf += read_file_range(fh, read_hi, more_hi)
+            read_hi = more_hi
+            last = buf.find(b'\n', hi - 1 - read_lo)
+        last = len(buf) if last == -1 else last + 1
+    fh.Close()
+
+    text = buf[first:last]
+    newlines = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == ord('\n'))
+    line_starts = np.concatenate(([0], newlines + 1))
+    if line_starts[-1] == len(text):
+        line_starts = line_starts[:-1]
+    num_lines = len(line_starts)
+
+    # Global index of this rank's first line
+    line_offset = comm.exscan(num_lines)
+    if rank == 0:
+        line_offset = 0
+
+    def parse_lines(first_line, last_line, width):
+        # Parses global lines [first_line, last_line) that fall in this rank's text
+        a = min(max(first_line - line_offset, 0), num_lines)
+        b = min(max(last_line - line_offset, 0), num_lines)
+        if a >= b:
+            return np.empty((0, width), dtype=np.int64)
+        end = line_starts[b] if b < num_lines else len(text)
+        return np.fromstring(text[line_starts[a]:end], dtype=np.int64, sep=' ').reshape(-1, width)
+
+    edges = parse_lines(2, 2 + num_edges, 2)
+    result = parse_lines(3 + num_edges, np.iinfo(np.int64).max, 3)
+
+    rows, cols = edges[:, 0].astype(np.int32), edges[:, 1].astype(np.int32)
+
+    # Per-row work estimates are summed over the ranks so every rank computes the same bounds.
+    # B is A transpose, so nnz of row k of B is the number of entries in column k of A.
+    nnz_work = np.empty(num_nodes, dtype=np.int64)
+    b_row_nnz = np.empty(num_nodes, dtype=np.int64)
+    flops_work = np.empty(num_nodes, dtype=np.int64)
+    comm.Allreduce(row_work(rows, cols, num_nodes), nnz_work, op=MPI.SUM)
+    comm.Allreduce(row_work(cols, rows, num_nodes), b_row_nnz, op=MPI.SUM)
+    comm.Allreduce(row_work(rows, cols, num_nodes, b_row_nnz), flops_work, op=MPI.SUM)
+    bounds, imbalance = plan_row_partition(partition, num_nodes, size, nnz_work, flops_work)
+    if rank == 0:
+        print(f"Row partition ({partition}): imbalance factor {imbalance:0.3f}")
+
+    ones = np.ones(len(rows), dtype=np.int64)
+    local_A = exchange_coo(COOMatrix(rows, cols, ones), np.searchsorted(bounds, rows, side='right') - 1, comm)
+    local_A_transpose = None
+    if transpose:
+        local_A_transpose = exchange_coo(COOMatrix(cols, rows, ones), np.searchsorted(bounds, cols, side='right') - 1, comm)
+    result_rows = result[:, 0].astype(np.int32)
+    local_result = exchange_coo(COOMatrix(result_rows, result[:, 1].astype(np.int32), np.ascontiguousarray(result[:, 2])),
+                                np.searchsorted(bounds, result_rows, side='right') - 1, comm)
+
+    return num_nodes, src_node, num_edges, bounds, sort_coo(local_A), sort_coo(local_A_transpose) if transpose else None, sort_coo(local_result)
+
+
+def convert_to_matrix(num_nodes, edge_list, dtype=np.float64):
+    """
+    Args:
+        edge_list: non-zero matrix entries, either a COOMatrix or a list of [row, col, w]
         num_nodes: int
+        dtype: element type of the result, e.g. np.int8 or np.float32 is enough for 0/1 adjacency data
 
     Returns:
         square_matrix: (num_nodes x num_nodes) matrix returned as a numpy array
     """
-    square_matrix = np.zeros((num_nodes, num_nodes))
-    for edge in edge_list:
-        row, col, w = edge[0], edge[1], edge[2]
-        square_matrix[row][col] = w
+    square_matrix = np.zeros((num_nodes, num_nodes), dtype=dtype)
+    if isinstance(edge_list, COOMatrix):
+        rows, cols, vals = edge_list
+    else:
+        entries = np.asarray(edge_list, dtype=np.int64).reshape(-1, 3)
+        rows, cols, vals = entries[:, 0], entries[:, 1], entries[:, 2]
+    # One scatter for all entries instead of a python loop
+    square_matrix[rows, cols] = vals
     return square_matrix
 
 
-def pad_matrix(matrix, q):
-    # Used when a matrix needs to be divisible into blocks, so n should be a multiple of sqrt(p)
-    n, m = matrix.shape
-    if n % q == 0:
-        return matrix
-    new_n = int(math.ceil(n / q)) * q
-    padded_matrix = np.pad(matrix, ((0, new_n - n), (0, new_n - m)), mode='constant', constant_values=0)
-    return padded_matrix
+def convert_to_bitset(num_nodes, edges):
+    """
+    Packs a 0/1 matrix straight from its COO entries, 64 columns per uint64 word, without building
+    the dense matrix. Bit (col % 64) of word (col // 64) in row row is set for every entry.
 
+    Returns:
+        (n x ceil(n / 64)) uint64 array, n = num_nodes
+    """
+    n = num_nodes
+    bits = np.zeros((n, (n + 63) // 64), dtype=np.uint64)
+    cols = edges.cols.astype(np.uint64)
+    np.bitwise_or.at(bits, (edges.rows, (cols >> np.uint64(6)).astype(np.int64)), np.uint64(1) << (cols & np.uint64(63)))
+    return bits
 
-def distribute_coo(edge_list):
-    a_send_rows =  np.zeros((size,))
-    a_send_indices =  np.zeros((size + 1,))
-    a_rows_to_rank = np.zeros((data[0],))
 
-    a_send_data = [ [] for _ in range(size) ]
+def counts_match(C, expected):
+    # Compares a dense count matrix with the expected COO result without densifying the expected one
+    rows, cols = np.nonzero(C)
+    return (np.array_equal(rows, expected.rows) and np.array_equal(cols, expected.cols)
+            and np.array_equal(C[rows, cols], expected.vals))
 
-    for i in range(size):
-        a_send_rows[i] = data[0] // size
-        if data[0] % size > i:
-            a_send_rows[i] += 1
-    
+
+def distribute_coo(coo, num_rows, comm, bounds=None):
+    """
+    Sends each rank its block of rows of a row-sorted COO matrix held on rank 0.
+    The row blocks are found with one searchsorted over the sorted rows, and the arrays are sent with
+    typed Scatterv calls, so nothing is pickled.
+
+    Args:
+        coo: COOMatrix sorted by row on rank 0, ignored on other ranks
+        num_rows: int
+        bounds: row bounds on rank 0, rank r gets rows [bounds[r], bounds[r + 1]).
+                Defaults to row_partition (equal number of rows per rank).
+
+    Returns:
+        COOMatrix holding this rank's rows
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    # Counts and displacements are computed once on the root and reused for all three arrays
+    counts = np.empty(size, dtype=np.int64)
     if rank == 0:
-        a_send_indices[0] = 0
-        for i in range(1, size + 1):
-            a_send_indices[i] = a_send_indices[i - 1] + a_send_rows[i - 1]
-        for i in range(size):
-            for j in range(int(a_send_indices[i]), int(a_send_indices[i + 1])):
-                a_rows_to_rank[j] = i
-        a_rows_to_rank = a_rows_to_rank.astype(int) 
-        for A_el in edge_list:
-            a_send_data[a_rows_to_rank[A_el[0]]].append(A_el)
+        if bounds is None:
+            bounds = row_partition(num_rows, size)
+        offsets = np.searchsorted(coo.rows, bounds)
+        counts[:] = np.diff(offsets)
+        displs = offsets[:-1]
+        sendbufs = (np.ascontiguousarray(coo.rows, dtype=np.int32),
+                    np.ascontiguousarray(coo.cols, dtype=np.int32),
+                    np.ascontiguousarray(coo.vals, dtype=np.int64))
+    else:
+        sendbufs = (None, None, None)
+    comm.Bcast(counts, root=0)
+
+    received = []
+    for sendbuf, dtype in zip(sendbufs, (np.int32, np.int32, np.int64)):
+        recvbuf = np.empty(int(counts[rank]), dtype=dtype)
+        comm.Scatterv([sendbuf, (counts, displs)] if rank == 0 else None, recvbuf, root=0)
+        received.append(recvbuf)
+    return COOMatrix(*received)
+
+
+def gather_coo(local, comm, root=0):
+    """
+    Collects every rank's (nnz x 3) int64 result on root with one typed Gatherv: only the entry
+    counts are exchanged first, then the arrays are copied straight into place without pickling.
+
+    Returns:
+        (total nnz x 3) array with the ranks' rows in rank order on root, None elsewhere
+    """
+    local = np.ascontiguousarray(local, dtype=np.int64).reshape(-1, 3)
+    counts = np.empty(comm.Get_size(), dtype=np.int64) if comm.Get_rank() == root else None
+    comm.Gather(np.array([local.size], dtype=np.int64), counts, root=root)
+    if comm.Get_rank() != root:
+        comm.Gatherv(local.ravel(), None, root=root)
+        return None
+    full = np.empty(int(counts.sum()), dtype=np.int64)
+    comm.Gatherv(local.ravel(), [full, (counts, np.cumsum(counts) - counts)], root=root)
+    return full.reshape(-1, 3)
+
+
+def build_sparse_inputs(parsed, transpose=True):
+    """
+    Builds the row-sorted COO arrays used by the spgemm modes: A, A transpose and the expected result.
+    Memory is proportional to nnz, no dense matrix is ever created.
+
+    Args:
+        parsed: SparseMatrixFile on rank 0, None on other ranks, or (local_A, local_A_transpose,
+                local_result) COO arrays when the input was loaded with parallel_read_sparse_matrix_file
+        transpose: if False, A transpose is not built and None is returned in its place
+    """
+    if parsed is None:
+        return None, None, None
+    if isinstance(parsed, SparseMatrixFile):
+        return sort_coo(parsed.edges), transpose_coo(parsed.edges) if transpose else None, parsed.spgemm_result
+    return tuple(parsed)
+
 
-    return a_send_data
+def build_dense_inputs(parsed, dtype=np.float64):
+    """
+    Dense A, A transpose and expected result, only needed by the dense modes.
+    blocked/cannon split any N into ragged blocks with Scatterv/Gatherv, so the matrices are never padded.
+    """
+    edges = parsed.edges
+    A = convert_to_matrix(parsed.num_nodes, edges, dtype=dtype)
+    A_transpose = convert_to_matrix(parsed.num_nodes, COOMatrix(edges.cols, edges.rows, edges.vals), dtype=dtype)
+    # The expected counts can exceed the range of a narrow dtype, keep them wide
+    spgemm_result = convert_to_matrix(parsed.num_nodes, parsed.spgemm_result, dtype=np.result_type(dtype, np.float64))
+    return A, A_transpose, spgemm_result
 
 
 def test_brute(num_nodes, A, B, expected_C):
@@ -105,7 +550,34 @@ def test_brute(num_nodes, A, B, expected_C):
         print(f"Time Taken for multiplying matrices of size ({num_nodes} x {num_nodes}): {end - start:0.4f} seconds") 
 
 
-def test_blocked(A, B, expected_C):
+def build_bitset_inputs(parsed):
+    # Packed A and B^T for the bitpacked modes. B = A^T, so B^T is A itself and is packed once.
+    A_bits = convert_to_bitset(parsed.num_nodes, parsed.edges)
+    return A_bits, A_bits, sort_coo(parsed.spgemm_result)
+
+
+def test_bitpacked(A_bits, B_T_bits, expected_C, distributed=False, dims=None):
+    start = time.perf_counter()
+
+    if distributed:
+        N = comm.bcast(A_bits.shape[0] if rank == 0 else None, root=0)
+        my_C = blocked_bitpacked_multiply(A_bits, B_T_bits, N, dims)
+    else:
+        my_C = bitpacked_multiply(A_bits, B_T_bits)
+
+    end = time.perf_counter()
+
+    if rank == 0:
+        print(f"Packed A and B^T: {(A_bits.nbytes + B_T_bits.nbytes) / 1e6:0.3f} MB, "
+              f"{A_bits.shape[0] * A_bits.shape[0] * 8 * 2 / 1e6:0.3f} MB as float64")
+        if counts_match(my_C, expected_C):
+            print("Result matrix matches!")
+        else:
+            print(f"\nExpected: \n\t{expected_C}\n\nGot: \n\t{my_C}\n")
+        print(f"Time Taken for multiplying matrices of size ({num_nodes} x {num_nodes}): {end - start:0.4f} seconds")
+
+
+def test_blocked(A, B, expected_C, shared=False, dims=None, summa=False, panel_width=None):
     start = time.perf_counter()
     
     if rank == 0:
@@ -113,10 +585,24 @@ def test_blocked(A, B, expected_C):
     else:
         N = None
     N = comm.bcast(N, root=0)
-    my_C = blocked_matrix_multiply(A, B, N)
+    stats = {}
+    if summa:
+        my_C = summa_matrix_multiply(A, B, N, dims, panel_width, stats)
+    elif shared:
+        my_C = blocked_matrix_multiply_shared(A, B, N, dims)
+    else:
+        my_C = blocked_matrix_multiply(A, B, N, dims)
 
     end = time.perf_counter()
 
+    if summa:
+        buffer_bytes = comm.reduce(stats['buffer_bytes'], op=MPI.MAX, root=0)
+        if rank == 0:
+            # Blocked holds the whole row strip of A and column strip of B instead of the panel buffers
+            strips = (-(-N // dims[0]) + -(-N // dims[1])) * N * A.itemsize
+            print(f"SUMMA: {stats['panels']} panels, panel buffers per rank: {buffer_bytes / 1e6:0.3f} MB "
+                  f"(row + column strips in blocked: {strips / 1e6:0.3f} MB)")
+
     if rank == 0:
         if np.array_equal(my_C, expected_C):
             print("Result matrix matches!")
@@ -126,7 +612,7 @@ def test_blocked(A, B, expected_C):
         print(f"Time Taken for multiplying matrices of size ({num_nodes} x {num_nodes}): {end - start:0.4f} seconds")
 
 
-def test_cannon(A, B, expected_C):
+def test_cannon(A, B, expected_C, dims=None, overlap=False):
     start = time.perf_counter()
     
     if rank == 0:
@@ -134,10 +620,22 @@ def test_cannon(A, B, expected_C):
     else:
         N = None
     N = comm.bcast(N, root=0)
-    my_C = cannon_matrix_multiply(A, B, N)
+    stats = {}
+    if overlap:
+        my_C = cannon_matrix_multiply_overlap(A, B, N, dims, stats)
+    else:
+        my_C = cannon_matrix_multiply(A, B, N, dims, stats)
 
     end = time.perf_counter()
 
+    # Time of the multiply-and-shift steps next to the part spent in np.dot: without overlap the steps take
+    # about compute + communication, with it about the larger of the two
+    loop_time = comm.reduce(stats['loop_time'], op=MPI.MAX, root=0)
+    compute_time = comm.reduce(stats['compute_time'], op=MPI.MAX, root=0)
+    if rank == 0:
+        print(f"Cannon steps ({'overlapped' if overlap else 'blocking'} shifts): {loop_time:0.4f} seconds, "
+              f"of which np.dot: {compute_time:0.4f} seconds (max over ranks)")
+
     if rank == 0:
         if np.array_equal(my_C, expected_C):
             print("Result matrix matches!")
@@ -147,34 +645,276 @@ def test_cannon(A, B, expected_C):
         print(f"Time Taken for multiplying matrices of size ({num_nodes} x {num_nodes}): {end - start:0.4f} seconds")
 
 
-def test_spgemm(A, B, expected_C, kind=1):
+def report_b_traffic(stats, label):
+    # Total bytes all ranks received to get the parts of B (and A, for spsumma) they multiply with
+    total = comm.reduce(stats.get('bytes_received', 0), op=MPI.SUM, root=0)
+    if rank == 0:
+        print(f"Bytes moved ({label}): {total / 1e6:0.3f} MB")
+    if 'b_bytes' in stats:
+        held = comm.reduce(stats['b_bytes'], op=MPI.SUM, root=0)
+        if rank == 0:
+            print(f"Memory held for B on all ranks: {held / 1e6:0.3f} MB")
+
+
+def report_busy_time(busy, chunks=None):
+    # Seconds each rank spent on its own rows, max / mean is the load imbalance actually observed
+    busy = comm.gather(busy, root=0)
+    chunks = comm.gather(chunks, root=0)
+    if rank == 0:
+        print(f"Busy time per rank (s): {[round(b, 4) for b in busy]}, imbalance factor {max(busy) / max(np.mean(busy), 1e-12):0.3f}")
+        if chunks[0] is not None:
+            print(f"Chunks per rank: {chunks}")
+
+
+def run_spgemm(kind, A, B, row_range, b_bounds, stats, memory_budget=None, chunk_size=64, shared_b=False):
+    # Runs the selected spgemm function and returns this rank's rows of C as an (nnz x 3) int64 array of [i, j, w]
+    if kind == 1:
+        C = coo_spgemm(num_nodes, num_nodes, num_nodes, A, B, row_range=row_range, b_bounds=b_bounds, stats=stats)
+        return np.asarray(C, dtype=np.int64).reshape(-1, 3)
+    if kind in (2, 5):
+        # kind 5 masks the product with the pattern of A itself, i.e. only c_ij where (i, j) is an edge
+        mask = A if kind == 5 else None
+        try:
+            C = csr_spgemm(num_nodes, num_nodes, num_nodes, A, B, row_range=row_range, b_bounds=b_bounds, stats=stats,
+                           mask=mask, max_output_bytes=memory_budget, shared_b=shared_b)
+        except MemoryError as e:
+            # The symbolic phase found that this rank's rows of C do not fit, stop before allocating them
+            print(f"Rank {rank}: {e}. Refusing to run, increase --memory-budget or use more ranks.")
+            comm.Abort(1)
+        return coo_array(csr_to_coo(*C, first_row=row_range[0]))
+    if kind == 3:
+        return spsumma_spgemm(num_nodes, num_nodes, num_nodes, A, B, row_range=row_range, stats=stats)
+    if kind == 6:
+        # Rows are handed out at runtime, row_range is not used
+        return dynamic_spgemm(num_nodes, num_nodes, num_nodes, A, B, chunk_size=chunk_size, stats=stats)
+    # A * A^T only needs A
+    return gram_spgemm(num_nodes, num_nodes, A, row_range=row_range, stats=stats)
+
+
+def plan_rows(A, B, partition):
+    # Row partition of A for the current number of ranks, see plan_row_partition
+    nnz_work = row_work(A.rows, A.cols, num_nodes)
+    # B is A transpose, nnz of row k of B is the number of entries in column k of A
+    b_row_nnz = row_work(B.rows, B.cols, num_nodes) if B is not None else row_work(A.cols, A.rows, num_nodes)
+    flops_work = row_work(A.rows, A.cols, num_nodes, b_row_nnz)
+    return plan_row_partition(partition, num_nodes, size, nnz_work, flops_work)
+
+
+def reorder_inputs(A, B, method, partition):
+    """
+    Relabels the vertices of A (and of B = A^T) with degree_order or rcm_order before the multiply.
+    The same permutation P is applied to rows and columns, so the product is P C P^T and
+    unpermute_entries maps it back. Prints what the reordering did to the bandwidth of A and the
+    imbalance of the row partition.
+
+    Returns:
+        (A, B, order): the permuted matrices and order, where new vertex v is old vertex order[v]
+    """
+    start = time.perf_counter()
+    order = degree_order(A, num_nodes) if method == 'degree' else rcm_order(A, num_nodes)
+    new_label = np.empty(num_nodes, dtype=np.int64)
+    new_label[order] = np.arange(num_nodes)
+    permuted_A = permute_coo(A, new_label)
+    permuted_B = permute_coo(B, new_label) if B is not None else None
+    elapsed = time.perf_counter() - start
+
+    _, imbalance_before = plan_rows(A, B, partition)
+    _, imbalance_after = plan_rows(permuted_A, permuted_B, partition)
+    print(f"Reordering ({method}) took {elapsed:0.4f} seconds: bandwidth {bandwidth(A)} -> {bandwidth(permuted_A)}, "
+          f"imbalance factor ({partition}) {imbalance_before:0.3f} -> {imbalance_after:0.3f}")
+    return permuted_A, permuted_B, order
+
+
+def degree_order(coo, num_rows):
+    # Vertices by increasing number of nonzeros in their row, ties keep their original order
+    return np.argsort(row_work(coo.rows, coo.cols, num_rows), kind='stable')
+
+
+def rcm_order(coo, num_rows):
+    """
+    Reverse Cuthill-McKee ordering of the symmetrized pattern of coo. Every connected component is
+    traversed breadth-first from its lowest-degree vertex, visiting neighbors by increasing degree,
+    and the whole order is reversed. Neighboring vertices get nearby labels, which pulls the
+    nonzeros towards the diagonal.
+    """
+    keys = np.unique(np.concatenate((coo.rows.astype(np.int64) * num_rows + coo.cols,
+                                     coo.cols.astype(np.int64) * num_rows + coo.rows)))
+    neighbors = keys % num_rows
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // num_rows, minlength=num_rows), out=indptr[1:])
+    degree = np.diff(indptr)
+
+    visited = np.zeros(num_rows, dtype=bool)
+    order = np.empty(num_rows, dtype=np.int64)
+    tail = 0
+    for root in np.argsort(degree, kind='stable'):
+        if visited[root]:
+            continue
+        visited[root] = True
+        order[tail] = root
+        head, tail = tail, tail + 1
+        # order[head:tail] is the BFS queue
+        while head < tail:
+            v = order[head]
+            head += 1
+            new = neighbors[indptr[v]:indptr[v + 1]]
+            new = new[~visited[new]]
+            if len(new):
+                new = new[np.argsort(degree[new], kind='stable')]
+                visited[new] = True
+                order[tail:tail + len(new)] = new
+                tail += len(new)
+    return order[::-1]
+
+
+def permute_coo(coo, new_label):
+    # Relabels rows and columns with new_label[old] and sorts the result by row again
+    return sort_coo(COOMatrix(new_label[coo.rows].astype(np.int32), new_label[coo.cols].astype(np.int32), coo.vals))
+
+
+def unpermute_entries(entries, order):
+    # Inverse of permute_coo for an (nnz x 3) array of [i, j, w]: back to the original labels, sorted by (i, j)
+    entries = entries.copy()
+    entries[:, 0] = order[entries[:, 0]]
+    entries[:, 1] = order[entries[:, 1]]
+    return entries[np.lexsort((entries[:, 1], entries[:, 0]))]
+
+
+def bandwidth(coo):
+    # Largest distance of a nonzero from the diagonal
+    return int(np.abs(coo.rows.astype(np.int64) - coo.cols).max()) if len(coo.rows) else 0
+
+
+def scatter_rows(A, B, partition, with_b=True):
+    # Rank 0 plans the row partition of A and every rank receives its rows of A (and of B)
+    bounds = np.empty(size + 1, dtype=np.int64)
     if rank == 0:
-        a_send_data = distribute_coo(A)
-        b_send_data = distribute_coo(B)
-        c_send_data = distribute_coo(expected_C)
+        bounds, imbalance = plan_rows(A, B, partition)
+        print(f"Row partition ({partition}): imbalance factor {imbalance:0.3f}")
+    comm.Bcast(bounds, root=0)
+    local_A = distribute_coo(A, num_nodes, comm, bounds)
+    local_B = distribute_coo(B, num_nodes, comm, bounds) if with_b else None
+    return bounds, local_A, local_B
+
+
+def peak_rss_mb():
+    # High-water mark of this process's resident set size, ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def test_spgemm_stream(A, B, expected_C, output, memory_budget, distributed=False, partition='rows', bounds=None, fetch_b='all'):
+    """
+    Runs stream_spgemm, which writes C to output in batches instead of returning it, then checks the file:
+    every rank reads back only its own rows and compares them with its rows of the expected result.
+    """
+    if distributed:
+        local_A, local_B, local_C = A, B, expected_C
     else:
-        a_send_data, b_send_data, c_send_data = None, None, None
-    
-    a_data_recvbuf = comm.scatter(a_send_data, root=0)
-    b_data_recvbuf = comm.scatter(b_send_data, root=0)
-    c_data_recvbuf = comm.scatter(c_send_data, root=0)
+        bounds, local_A, local_B = scatter_rows(A, B, partition)
+        local_C = distribute_coo(expected_C, num_nodes, comm, bounds)
+
+    row_range = (int(bounds[rank]), int(bounds[rank + 1]))
+    b_bounds = bounds if fetch_b == 'needed' else None
+    stats = {}
+    a_data, b_data = coo_array(local_A), coo_array(local_B)
+    rss_before = peak_rss_mb()
 
     start = time.perf_counter()
-    if kind == 1:
-        my_C = coo_spgemm(num_nodes, num_nodes, num_nodes, a_data_recvbuf, b_data_recvbuf)
-        my_C = comm.gather(my_C, root=0)
+    nnz, num_batches, largest_batch = stream_spgemm(num_nodes, num_nodes, num_nodes, a_data, b_data, output,
+                                                    memory_budget, row_range=row_range, b_bounds=b_bounds, stats=stats)
+    end = time.perf_counter()
+    report_b_traffic(stats, "B, only needed rows" if fetch_b == 'needed' else "B, allgather")
+
+    rss = comm.gather((peak_rss_mb(), rss_before, num_batches, largest_batch), root=0)
+    if rank == 0:
+        print(f"Time Taken for multiplying matrices of size ({num_nodes} x {num_nodes}) into {output}: {end - start:0.4f} seconds")
+        print(f"Batches per rank: {[r[2] for r in rss]}, largest batch {max(r[3] for r in rss) / 1e6:0.2f} MB (budget {memory_budget / 1e6:0.2f} MB)")
+        print(f"Peak RSS per rank (MB): {[round(r[0], 1) for r in rss]}, before the multiply: {[round(r[1], 1) for r in rss]}")
+
+    # Rows of each rank are contiguous in the file, the offset is the nnz of all lower ranks
+    offset = comm.exscan(nnz) or 0
+    written = np.memmap(output, dtype=np.int64, mode='r', offset=offset * 3 * 8, shape=(nnz, 3)) if nnz else np.empty((0, 3), dtype=np.int64)
+    matches = comm.allreduce(np.array_equal(written, coo_array(local_C)), op=MPI.LAND)
+    if rank == 0 and matches:
+        print("Result matrix matches!")
+    elif not matches and not np.array_equal(written, coo_array(local_C)):
+        print(f"Rank {rank}: rows {row_range[0]} to {row_range[1] - 1} of {output} do not match the expected result")
+
+
+def test_spgemm(A, B, expected_C, kind=1, distributed=False, partition='rows', bounds=None, fetch_b='all', memory_budget=None, reorder='none', chunk_size=64, shared_b=False):
+    if kind == 5 and expected_C is not None:
+        # The masked product only has the entries of A*A^T at the positions of A's edges
+        expected_C = restrict_coo(expected_C, A, num_nodes)
+
+    order = None
+    if distributed:
+        # Each rank already holds its own rows (parallel_read_sparse_matrix_file)
+        local_A, local_B, local_C = A, B, expected_C
+    else:
+        if reorder != 'none' and rank == 0:
+            # Multiply in the new labels, expected_C stays in the original ones
+            A, B, order = reorder_inputs(A, B, reorder, partition)
+        bounds, local_A, local_B = scatter_rows(A, B, partition, with_b=kind != 4)
+        local_C = None
         if rank == 0:
-            my_C = [item for sublist in my_C for item in sublist]
+            expected_C = coo_array(expected_C)
+
+    # The COO kernel works on lists of [i, j, w], the other kernels take (nnz x 3) arrays directly
+    as_input = coo_to_list if kind == 1 else coo_array
+    a_data_recvbuf = as_input(local_A)
+    b_data_recvbuf = as_input(local_B) if local_B is not None else None
+    c_data_recvbuf = coo_array(local_C) if distributed else None
+    row_range = (int(bounds[rank]), int(bounds[rank + 1]))
+    # B is distributed with the same bounds as A, which is what fetch_b_rows needs to find row owners
+    b_bounds = bounds if fetch_b == 'needed' else None
+    stats = {}
+    if kind == 3:
+        traffic_label = "2D block broadcasts"
+    elif kind == 4:
+        traffic_label = "A, allgather"
+    elif kind == 6:
+        traffic_label = "A and B, allgather"
+    elif shared_b:
+        traffic_label = "B, one copy per node"
     else:
-        my_C = csr_spgemm(num_nodes, num_nodes, num_nodes, a_data_recvbuf, b_data_recvbuf)
-        my_C = comm.gather(my_C, root=0)
+        traffic_label = "B, only needed rows" if fetch_b == 'needed' else "B, allgather"
+
+    start = time.perf_counter()
+    if distributed:
+        # Verify each rank's rows against its own slice of the expected result, so rank 0
+        # never has to hold the full product.
+        my_C = run_spgemm(kind, a_data_recvbuf, b_data_recvbuf, row_range, b_bounds, stats, memory_budget, chunk_size, shared_b)
+        busy = stats.get('busy_time', time.perf_counter() - start)
+        matches = comm.allreduce(np.array_equal(my_C, c_data_recvbuf), op=MPI.LAND)
+        end = time.perf_counter()
+        report_b_traffic(stats, traffic_label)
+        report_busy_time(busy, stats.get('chunks'))
         if rank == 0:
-            my_C = [item for sublist in my_C for item in sublist]
+            print(f"Time Taken for multiplying matrices of size ({num_nodes} x {num_nodes}): {end - start:0.4f} seconds")
+            if matches:
+                print("Result matrix matches!")
+        if not matches and not np.array_equal(my_C, c_data_recvbuf):
+            print(f"Rank {rank} expected: \n\n{c_data_recvbuf}\n\nGot: \n\n{my_C}\n")
+        return
+
+    my_C = run_spgemm(kind, a_data_recvbuf, b_data_recvbuf, row_range, b_bounds, stats, memory_budget, chunk_size, shared_b)
+    busy = stats.get('busy_time', time.perf_counter() - start)
+    gather_start = time.perf_counter()
+    # Ranks hold contiguous, sorted row blocks, so the rank-ordered result is already sorted by (i, j)
+    my_C = gather_coo(my_C, comm)
+    if rank == 0 and kind == 6:
+        # Except with dynamic scheduling, where every rank computed a scattered set of chunks
+        my_C = my_C[np.lexsort((my_C[:, 1], my_C[:, 0]))]
+    if order is not None:
+        my_C = unpermute_entries(my_C, order)
     end = time.perf_counter()
+    report_b_traffic(stats, traffic_label)
+    report_busy_time(busy, stats.get('chunks'))
 
     if rank == 0:
         print(f"Time Taken for multiplying matrices of size ({num_nodes} x {num_nodes}): {end - start:0.4f} seconds")
-        if my_C == expected_C:
+        print(f"Time Taken for collecting the result on rank 0: {end - gather_start:0.4f} seconds")
+        if np.array_equal(my_C, expected_C):
             print("Result matrix matches!")
         else:
             print(f"Expected: \n\n{expected_C}\n\nGot: \n\n{my_C}\n")
@@ -184,75 +924,141 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser(prog='Driver code')
     parser.add_argument('-f', '--file', type=str)
     parser.add_argument('-o', '--optim', type=str)
+    parser.add_argument('--dtype', type=np.dtype, default=np.float64, help='element type of the dense matrices, e.g. float32. Integer types must be wide enough to hold the entries of A*A^T')
+    parser.add_argument('--partition', choices=['rows', 'nnz', 'flops'], default='rows', help='spgemm modes: how rows of A are split between ranks')
+    parser.add_argument('--fetch-b', choices=['all', 'needed'], default='all', help='spgemm modes: allgather all of B, or fetch only the rows of B each rank uses')
+    parser.add_argument('--memory-budget', type=float, default=None, help='spgemm2/masked: per-rank limit in MB for the result, checked before it is allocated. '
+                        'stream: MB of the result a rank holds at once (default 64)')
+    parser.add_argument('--output', type=str, default='spgemm_result.bin', help='stream: file the result is written to, as int64 [i, j, c_ij] triples')
+    parser.add_argument('--schedule', choices=['static', 'dynamic'], default='static', help='spgemm2: fixed row blocks per rank, or chunks of rows handed out at runtime')
+    parser.add_argument('--chunk-size', type=int, default=64, help='spgemm2 with --schedule dynamic: rows handed out per request')
+    parser.add_argument('--shared-memory', action='store_true', help='spgemm2/masked/blocked: keep one copy of B (blocked: of A and B) per node in shared memory')
+    parser.add_argument('--grid', type=lambda text: [int(d) for d in text.lower().split('x')], default=None,
+                        help='blocked/cannon: process grid as PRxPC, e.g. 2x3. A 0 lets MPI choose that dimension. Default: MPI.Compute_dims')
+    parser.add_argument('--summa', action='store_true', help='blocked: broadcast one panel per stage (SUMMA) instead of allgathering the row and column strips')
+    parser.add_argument('--panel-width', type=int, default=None, help='blocked with --summa: columns of A / rows of B per panel, defaults to the width of a block')
+    parser.add_argument('--overlap', action='store_true', help='cannon: shift the next blocks with Isend/Irecv while the current ones are multiplied')
+    parser.add_argument('--bitpack', action='store_true', help='brute/blocked: multiply 0/1 adjacency matrices packed into uint64 bitsets with popcount')
+    parser.add_argument('--reorder', choices=['none', 'degree', 'rcm'], default='none', help='spgemm modes: relabel the vertices by degree or with reverse Cuthill-McKee before the multiply')
+    parser.add_argument('--parallel-io', action='store_true', help='spgemm modes: every rank reads its part of the input with MPI-IO')
+    parser.add_argument('--no-cache', action='store_true', help='always parse the text input, never read or write the binary cache')
     args = parser.parse_args()
+    memory_budget = int(args.memory_budget * 1e6) if args.memory_budget is not None else None
 
     comm = MPI.COMM_WORLD
     size = comm.Get_size()
     rank = comm.Get_rank()
 
+    # Shape of the blocked/cannon process grid, any number of ranks can be laid out as pr x pc
+    grid = args.grid if args.grid is not None else [0, 0]
+    if len(grid) != 2 or any(d < 0 or (d and size % d) for d in grid) or (all(grid) and grid[0] * grid[1] != size):
+        parser.error(f"--grid must be PRxPC with PR * PC = {size}")
+    grid = list(MPI.Compute_dims(size, grid))
+
+    sparse_modes = ("spgemm1", "spgemm2", "spsumma", "gram", "masked", "stream")
+    parallel_io = args.parallel_io and args.optim in sparse_modes
+    if args.reorder != 'none' and (parallel_io or args.optim == 'stream'):
+        # The permutation needs the whole graph on rank 0, and the streamed file cannot be unpermuted in memory
+        parser.error("--reorder needs the input on rank 0 and an in-memory result, it cannot be used with --parallel-io or -o stream")
+    if args.schedule == 'dynamic' and parallel_io:
+        # Any rank may compute any row, so the result is checked on rank 0 instead of per rank
+        parser.error("--schedule dynamic cannot be used with --parallel-io")
+    if args.summa and (args.shared_memory or args.bitpack):
+        parser.error("--summa cannot be combined with --shared-memory or --bitpack")
+    if args.panel_width is not None and args.panel_width < 1:
+        parser.error("--panel-width must be at least 1")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+
     num_nodes, src_node, num_edges = 0, 0, 0
-    edge_list, spgemm_result = None, []
-    if rank == 0:
-        num_nodes, src_node, num_edges, edge_list, spgemm_result = read_sparse_matrix_file(args.file)
+    parsed, bounds = None, None
+    if parallel_io:
+        load_start = time.perf_counter()
+        num_nodes, src_node, num_edges, bounds, *parsed = parallel_read_sparse_matrix_file(args.file, comm, partition=args.partition, transpose=args.optim != 'gram')
+        load_time = comm.reduce(time.perf_counter() - load_start, op=MPI.MAX, root=0)
+        if rank == 0:
+            print(f"Time Taken for loading input with MPI-IO on {size} ranks: {load_time:0.4f} seconds")
+        data = (num_nodes, src_node, num_edges)
+    elif rank == 0:
+        parsed = load_sparse_matrix_file(args.file, use_cache=not args.no_cache)
+        num_nodes, src_node, num_edges = parsed.num_nodes, parsed.src_node, parsed.num_edges
         data = (num_nodes, src_node, num_edges)
     else:
         data = None
-    data = comm.bcast(data, root=0)
-
-    matrix_A = []
-    matrix_A_transpose = []    
-    if rank == 0:
-        for edge in edge_list:
-            edge.append(1)
-            matrix_A.append(edge)
-            matrix_A_transpose.append([edge[1], edge[0], edge[2]])
-        matrix_A.sort(key=lambda x: (x[0], x[1]))
-        matrix_A_transpose.sort(key=lambda x: (x[0], x[1]))
-
-        square_matrix_A = convert_to_matrix(num_nodes, matrix_A)
-        square_matrix_A_transpose = convert_to_matrix(num_nodes, matrix_A_transpose)
-        square_spgemm_result = convert_to_matrix(num_nodes, spgemm_result)
+    if not parallel_io:
+        data = comm.bcast(data, root=0)
+        num_nodes, src_node, num_edges = data
 
+    # Inputs are built lazily inside each mode below: the sparse modes only ever need the O(nnz)
+    # COO lists, and the dense N x N matrices are only materialized for brute/blocked/cannon.
+    square_matrix_A, square_matrix_A_transpose, square_spgemm_result = None, None, None
 
     if args.optim == "brute":
         if rank == 0:
             print("\n=================================Testing Bruteforce Algorithm===============================")
-            test_brute(num_nodes, square_matrix_A, square_matrix_A_transpose, square_spgemm_result) 
+            if args.bitpack:
+                test_bitpacked(*build_bitset_inputs(parsed))
+            else:
+                square_matrix_A, square_matrix_A_transpose, square_spgemm_result = build_dense_inputs(parsed, dtype=args.dtype)
+                test_brute(num_nodes, square_matrix_A, square_matrix_A_transpose, square_spgemm_result) 
 
     elif args.optim == "blocked":
         if rank == 0:
             print("\n====================Testing Blocked Matrix-Matrix Multiplication Algorithm==================")
-        if rank != 0:
-            square_matrix_A = None
-            square_matrix_A_transpose = None
-            square_spgemm_result = None
+        if args.bitpack:
+            bits_A, bits_B_T, spgemm_result = build_bitset_inputs(parsed) if rank == 0 else (None, None, None)
+            test_bitpacked(bits_A, bits_B_T, spgemm_result, distributed=True, dims=grid)
         else:
-            square_matrix_A = pad_matrix(square_matrix_A, int(np.sqrt(size)))
-            square_matrix_A_transpose = pad_matrix(square_matrix_A_transpose, int(np.sqrt(size)))
-            square_spgemm_result = pad_matrix(square_spgemm_result, int(np.sqrt(size)))
-        test_blocked(square_matrix_A, square_matrix_A_transpose, square_spgemm_result)
+            if rank == 0:
+                square_matrix_A, square_matrix_A_transpose, square_spgemm_result = build_dense_inputs(parsed, dtype=args.dtype)
+            test_blocked(square_matrix_A, square_matrix_A_transpose, square_spgemm_result, shared=args.shared_memory, dims=grid,
+                         summa=args.summa, panel_width=args.panel_width)
 
     elif args.optim == "cannon":
         if rank == 0:
             print("\n===================Testing Cannon's Matrix-Matrix Multiplication Algorithm=================")
-        if rank != 0:
-            square_matrix_A = None
-            square_matrix_A_transpose = None
-            square_spgemm_result = None
-        else:
-            square_matrix_A = pad_matrix(square_matrix_A, int(np.sqrt(size)))
-            square_matrix_A_transpose = pad_matrix(square_matrix_A_transpose, int(np.sqrt(size)))
-            square_spgemm_result = pad_matrix(square_spgemm_result, int(np.sqrt(size)))
-        test_cannon(square_matrix_A, square_matrix_A_transpose, square_spgemm_result)
+        if rank == 0:
+            square_matrix_A, square_matrix_A_transpose, square_spgemm_result = build_dense_inputs(parsed, dtype=args.dtype)
+        test_cannon(square_matrix_A, square_matrix_A_transpose, square_spgemm_result, dims=grid, overlap=args.overlap)
     elif args.optim == "spgemm1":
         if rank == 0:
             print("\n=================Testing Spgemm Matrix-Matrix Multiplication Algorithm w/ COO===============")
-        test_spgemm(matrix_A, matrix_A_transpose, spgemm_result, kind=1)
+        matrix_A, matrix_A_transpose, spgemm_result = build_sparse_inputs(parsed)
+        test_spgemm(matrix_A, matrix_A_transpose, spgemm_result, kind=1, distributed=parallel_io, partition=args.partition, bounds=bounds, fetch_b=args.fetch_b, reorder=args.reorder)
 
     elif args.optim == "spgemm2":
         if rank == 0:
             print("\n=================Testing Spgemm Matrix-Matrix Multiplication Algorithm w/ CSR===============")
-        test_spgemm(matrix_A, matrix_A_transpose, spgemm_result, kind=2)
+        matrix_A, matrix_A_transpose, spgemm_result = build_sparse_inputs(parsed)
+        test_spgemm(matrix_A, matrix_A_transpose, spgemm_result, kind=6 if args.schedule == 'dynamic' else 2, distributed=parallel_io, partition=args.partition,
+                    bounds=bounds, fetch_b=args.fetch_b, memory_budget=memory_budget, reorder=args.reorder, chunk_size=args.chunk_size,
+                    shared_b=args.shared_memory)
+
+    elif args.optim == "stream":
+        if rank == 0:
+            print("\n==========Testing Out-of-Core Spgemm Matrix-Matrix Multiplication Algorithm w/ CSR===========")
+        matrix_A, matrix_A_transpose, spgemm_result = build_sparse_inputs(parsed)
+        test_spgemm_stream(matrix_A, matrix_A_transpose, spgemm_result, args.output, memory_budget or 64 * 10**6, distributed=parallel_io,
+                           partition=args.partition, bounds=bounds, fetch_b=args.fetch_b)
+
+    elif args.optim == "spsumma":
+        if rank == 0:
+            print("\n==============Testing 2D Sparse SUMMA Matrix-Matrix Multiplication Algorithm w/ CSR==========")
+        matrix_A, matrix_A_transpose, spgemm_result = build_sparse_inputs(parsed)
+        test_spgemm(matrix_A, matrix_A_transpose, spgemm_result, kind=3, distributed=parallel_io, partition=args.partition, bounds=bounds, reorder=args.reorder)
+
+    elif args.optim == "masked":
+        if rank == 0:
+            print("\n=========Testing Masked Spgemm (A*A^T on the edges of A) Multiplication Algorithm w/ CSR=======")
+        matrix_A, matrix_A_transpose, spgemm_result = build_sparse_inputs(parsed)
+        test_spgemm(matrix_A, matrix_A_transpose, spgemm_result, kind=5, distributed=parallel_io, partition=args.partition, bounds=bounds, fetch_b=args.fetch_b,
+                    memory_budget=memory_budget, reorder=args.reorder, shared_b=args.shared_memory)
+
+    elif args.optim == "gram":
+        if rank == 0:
+            print("\n=============Testing Symmetric A*A^T (Gram) Multiplication Algorithm, Upper Triangle===========")
+        matrix_A, _, spgemm_result = build_sparse_inputs(parsed, transpose=False)
+        test_spgemm(matrix_A, None, spgemm_result, kind=4, distributed=parallel_io, partition=args.partition, bounds=bounds, reorder=args.reorder)
 
     else:
         print("Invalid optimization method selected.")
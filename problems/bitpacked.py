@@ -0,0 +1,43 @@
+from mpi4py import MPI
+import numpy as np
+
+def bitpacked_multiply(A_bits, B_T_bits, chunk_bytes=1 << 25):
+    """
+    BONUS: Boolean matrix product with counts, for 0/1 matrices stored as bitsets. Bit k of row i is
+    set when a_ik = 1, so c_ij = sum_k a_ik * b_kj = popcount(row i of A & row j of B^T).
+
+    Args:
+        A_bits: (m x w) uint64 array, the rows of A packed 64 columns per word
+        B_T_bits: (n x w) uint64 array, the rows of B^T (columns of B) packed the same way
+        chunk_bytes: rows of A are processed in chunks whose (rows x n x w) temporary is about this size
+
+    Returns:
+        C: (m x n) int32 matrix of counts
+
+    TODO:
+        1. For a chunk of rows of A, AND every row with every row of B^T using broadcasting:
+           A_bits[lo:hi, None, :] & B_T_bits[None, :, :]
+        2. Count the set bits of every word (np.bitwise_count) and sum them over the words.
+    """
+    raise NotImplementedError
+
+
+def blocked_bitpacked_multiply(A_bits, B_T_bits, N, dims=None):
+    """
+    BONUS: bitpacked_multiply on the same pr x pc grid as blocked_matrix_multiply.
+
+    Args:
+        A_bits, B_T_bits: (N x w) packed matrices on rank 0, ignored on other ranks. Blocks are ragged when pr or pc does not divide N.
+        dims: optional [pr, pc] shape of the process grid, see blocked_matrix_multiply
+
+    Returns:
+        C: (N x N) int32 matrix of counts on rank 0, None elsewhere
+
+    TODO:
+        1. Process (i, j) needs row block i of A and row block j of B^T (all of their words).
+           Scatter these blocks from rank 0 with Scatterv, since the blocks can differ in size.
+        2. Compute the local block of C with bitpacked_multiply.
+        3. Gather the blocks of C at the root and reassemble them as in blocked_matrix_multiply
+           (block_bounds, block_types and gather_blocks from problems/blocked.py can be reused).
+    """
+    raise NotImplementedError
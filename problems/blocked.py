@@ -1,20 +1,31 @@
 from mpi4py import MPI
+from mpi4py.util import dtlib
 import numpy as np
 
-def blocked_matrix_multiply(A, B, N):
+def blocked_matrix_multiply(A, B, N, dims=None):
+    """
+    Args:
+        A, B: (N x N) matrices on rank 0, ignored on other ranks. N can be anything, blocks are ragged
+              when pr or pc does not divide it.
+        dims: optional [pr, pc] shape of the process grid, pr * pc must equal the number of processes.
+              Entries left as 0 (or dims=None) are chosen by MPI.Compute_dims, as square as possible.
+    """
     comm = MPI.COMM_WORLD
 
     rank = comm.Get_rank()
     size = comm.Get_size()
 
     n = N
-    q = int(np.sqrt(size))
+    # The processes form a pr x pc grid, any number of processes works
+    pr, pc = MPI.Compute_dims(size, dims or [0, 0])
+    assert pr*pc == size
 
-    # size must be a perfect square. q should divide n so that each process has the same size block.
-    assert q*q == size
-    assert n % q == 0
-
-    block_size = n // q
+    # Block row i is rows row_bounds[i] ... row_bounds[i+1]-1, block column j is cols col_bounds[j] ... col_bounds[j+1]-1.
+    # When n is not divisible, the first blocks are one larger, so no padding is needed.
+    row_bounds = block_bounds(n, pr)
+    col_bounds = block_bounds(n, pc)
+    heights = np.diff(row_bounds)
+    widths = np.diff(col_bounds)
 
     if rank == 0:
         if A is None or B is None:
@@ -26,13 +37,8 @@ def blocked_matrix_multiply(A, B, N):
 
     mat_dtype = comm.bcast(mat_dtype, root=0)
 
-    # Create local blocks. Each process receives a block_size * block_size square.
-    local_A = np.empty((block_size, block_size), dtype=mat_dtype)
-    local_B = np.empty((block_size, block_size), dtype=mat_dtype)
-    local_C = np.zeros((block_size, block_size), dtype=mat_dtype)
-
     # Define the Cartesian communicator. The processes are laid out into a 2D grid, the period indicates wrap-around.
-    dims = [q, q]
+    dims = [pr, pc]
     periods = [1, 1]
     comm_cart = comm.Create_cart(dims, periods, reorder=True)
 
@@ -40,60 +46,148 @@ def blocked_matrix_multiply(A, B, N):
     cart_rank = comm_cart.Get_rank()
     coords = comm_cart.Get_coords(cart_rank)
 
-    # Create blocks of A and B
-    if cart_rank == 0:
-        A_blocks = np.empty((size, block_size, block_size), dtype=A.dtype)
-        B_blocks = np.empty((size, block_size, block_size), dtype=B.dtype)
-        idx = 0
-        for i in range(q):
-            for j in range(q):
-                # These 2 lines create the blocks and ensure each block is contiguous so that they can be distributed
-                A_blocks[idx] = np.ascontiguousarray(A[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size])
-                B_blocks[idx] = np.ascontiguousarray(B[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size])
-                idx += 1
-    else:
-        A_blocks = None
-        B_blocks = None
-
-    # TODO: Distribute the blocks of A and B to all other processes.
-    # This requires 1 MPI instruction for the A blocks and 1 MPI instruction for the B blocks
-
-
+    # Create local blocks. Process (i, j) receives a heights[i] * widths[j] block.
+    local_A = np.empty((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+    local_B = np.empty((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+    local_C = np.zeros((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
 
+    # Scatter blocks of A and B. Each block is described by a datatype, so MPI reads it in place out of A and B,
+    # without first copying the blocks one after another. A, B and C all use the same blocks.
+    types = block_types(mat_dtype, n, row_bounds, col_bounds) if cart_rank == 0 else None
+    scatter_blocks(comm_cart, A, types, local_A)
+    scatter_blocks(comm_cart, B, types, local_B)
 
     # Create subcommunicators along the rows and columns.
     row_comm = comm_cart.Split(color=coords[0], key=coords[1])
     col_comm = comm_cart.Split(color=coords[1], key=coords[0])
-    
-    # Each process in a row collects all A blocks in that row and B blocks in the column
-    row_A_blocks = np.empty((q, block_size, block_size), dtype=local_A.dtype)
-    # TODO: Add an MPI instruction to collect all A blocks in the row into row_A_blocks
-    
-    col_B_blocks = np.empty((q, block_size, block_size), dtype=local_B.dtype)
-    # TODO: Add an MPI instruction to collect all B blocks in the column into col_B_blocks
-    
-    # Compute local C as:
-    # C_{ij} = sum_{k=0}^{q-1} A_{ik} * B_{kj}
-    for k in range(q):
-        local_C += np.dot(row_A_blocks[k], col_B_blocks[k])
 
-    # Send all local_C blocks to the root process.
-    collected_C = None
-    if cart_rank == 0:
-        collected_C = np.empty((size, block_size, block_size), dtype=local_C.dtype)
-    
-    # TODO: Add an MPI instruction to get all of the blocks back to the root (process 0).
+    # Each process in a row collects all A blocks in that row (pc of them) and B blocks in the column (pr of them)
+    row_counts = heights[coords[0]] * widths
+    row_displs = np.cumsum(row_counts) - row_counts
+    row_A_blocks = np.empty(n * heights[coords[0]], dtype=local_A.dtype)
+    # TODO: Add an MPI instruction to collect all A blocks in the row into row_A_blocks, using row_counts and row_displs
 
+    # The column blocks stacked on top of each other are the whole column strip of B (n x widths[j]).
+    col_counts = heights * widths[coords[1]]
+    col_displs = np.cumsum(col_counts) - col_counts
+    col_B_strip = np.empty((n, widths[coords[1]]), dtype=local_B.dtype)
+    # TODO: Add an MPI instruction to collect all B blocks in the column into col_B_strip, using col_counts and col_displs
 
+    # Compute local C as:
+    # C_{ij} = sum_{k=0}^{pc-1} A_{ik} * B_{kj}, where A_{ik} is the k-th gathered block of the row and
+    # B_{kj} the rows col_bounds[k] ... col_bounds[k+1]-1 of the strip, the same inner indices
+    for k in range(pc):
+        A_ik = row_A_blocks[row_displs[k]:row_displs[k] + row_counts[k]].reshape(heights[coords[0]], widths[k])
+        local_C += np.dot(A_ik, col_B_strip[col_bounds[k]:col_bounds[k+1]])
 
+    # Gather C at the root, every block goes straight to its place in the result matrix
+    result = np.empty((n, n), dtype=local_C.dtype) if cart_rank == 0 else None
+    gather_blocks(comm_cart, local_C, result, types)
 
-    # Process 0 combines all of the block of C into 1 result matrix.
     if cart_rank == 0:
-        result = np.empty((n, n), dtype=local_C.dtype)
-        idx = 0
-        for i in range(q):
-            for j in range(q):
-                result[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size] = collected_C[idx]
-                idx += 1
-        return result
-    return None
+        free_types(types)
+    return result
+
+
+def block_bounds(n, parts):
+    # Splits n rows/cols into parts contiguous blocks, the first (n % parts) blocks get one extra
+    counts = np.full(parts, n // parts, dtype=np.int64)
+    counts[:n % parts] += 1
+    bounds = np.zeros(parts + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    return bounds
+
+
+def block_types(dtype, n, row_bounds, col_bounds):
+    # One datatype per block (i, j), in cart_rank (row-major) order, that selects the block inside an n x n matrix.
+    # MPI does not allow empty subarrays, so empty blocks get None and are sent as 0 elements.
+    base = dtlib.from_numpy_dtype(dtype)
+    types = []
+    for i in range(len(row_bounds) - 1):
+        for j in range(len(col_bounds) - 1):
+            shape = [int(row_bounds[i+1] - row_bounds[i]), int(col_bounds[j+1] - col_bounds[j])]
+            if shape[0] and shape[1]:
+                types.append(base.Create_subarray([n, n], shape, [int(row_bounds[i]), int(col_bounds[j])]).Commit())
+            else:
+                types.append(None)
+    return types
+
+
+def free_types(types):
+    for t in types:
+        if t is not None:
+            t.Free()
+
+
+def scatter_blocks(comm, M, types, local, root=0):
+    """
+    Scatterv with a different datatype per process: process r receives the part of M (on the root)
+    selected by types[r] into the contiguous array local. Scatterv only takes one datatype, which
+    cannot describe ragged or strided blocks, so this is an Alltoallw in which only the root sends.
+    """
+    size = comm.Get_size()
+    base = dtlib.from_numpy_dtype(local.dtype)
+    zeros = [0] * size
+    recv_counts = [local.size if r == root else 0 for r in range(size)]
+    if comm.Get_rank() == root:
+        send = [M, ([int(t is not None) for t in types], zeros), [t or base for t in types]]
+    else:
+        send = [local, (zeros, zeros), [base] * size]
+    recv = [local, (recv_counts, zeros), [base] * size]
+    # TODO: Add the MPI instruction that sends every part of M to its process and receives local.
+    # Scatterv only takes one datatype for all processes, look for the collective that takes one datatype per process.
+    # send and recv are already set up for it.
+
+
+
+def gather_blocks(comm, local, M, types, root=0):
+    # The reverse of scatter_blocks: local of process r is written into the part of M (on the root) selected by types[r]
+    size = comm.Get_size()
+    base = dtlib.from_numpy_dtype(local.dtype)
+    zeros = [0] * size
+    send_counts = [local.size if r == root else 0 for r in range(size)]
+    if comm.Get_rank() == root:
+        recv = [M, ([int(t is not None) for t in types], zeros), [t or base for t in types]]
+    else:
+        recv = [local, (zeros, zeros), [base] * size]
+    send = [local, (send_counts, zeros), [base] * size]
+    # TODO: Add the MPI instruction that sends local to the root and receives every part of M there (same collective as above).
+
+
+
+def summa_matrix_multiply(A, B, N, dims=None, panel_width=None, stats=None):
+    """
+    BONUS: SUMMA on the same grid and blocks as blocked_matrix_multiply. Instead of allgathering whole
+    row and column strips, one panel of the inner dimension is broadcast per stage, so every process
+    only holds O(b^2) elements.
+
+    TODO:
+        1. Scatter A and B as above and split comm_cart into row_comm and col_comm.
+        2. Cut the inner dimension into panels of at most panel_width that do not cross col_bounds
+           (blocks of columns of A) or row_bounds (blocks of rows of B).
+        3. For every panel, the process of the grid row that owns those columns of A broadcasts them
+           along row_comm, and the process of the grid column that owns those rows of B broadcasts
+           them along col_comm. Accumulate local_C += A_panel @ B_panel.
+        4. Use two pairs of panel buffers: post the Ibcast of the next panel before multiplying the
+           current one, and wait for it at the start of the next stage.
+        5. Fill stats['panels'] and stats['buffer_bytes'] and gather C at the root as above.
+    """
+    raise NotImplementedError
+
+
+def blocked_matrix_multiply_shared(A, B, N, dims=None):
+    """
+    BONUS: blocked_matrix_multiply with one copy of A and B per node instead of a strip of each
+    per process.
+
+    TODO:
+        1. Set up comm_cart as above and split it into the processes of each node with
+           comm_cart.Split_type(MPI.COMM_TYPE_SHARED).
+        2. Allocate the row strips of A and the column strips of B used by the node's processes on
+           its first process with MPI.Win.Allocate_shared (size 0 on the others) and map them on
+           every process with win.Shared_query(0).
+        3. Send each node's strips from the root to the first process of the node, then Barrier on the node.
+        4. Compute local_C from the row panel of A and the column panel of B read in place,
+           then gather C at the root as above.
+    """
+    raise NotImplementedError
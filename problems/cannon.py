@@ -1,20 +1,54 @@
 from mpi4py import MPI
+from mpi4py.util import dtlib
 import numpy as np
+import math
 
-def cannon_matrix_multiply(A, B, N):
+# scatter_blocks and gather_blocks are the ones you complete in blocked.py
+from problems.blocked import block_bounds, free_types, scatter_blocks, gather_blocks
+
+
+def cannon_matrix_multiply(A, B, N, dims=None, stats=None):
+    """
+    Cannon's algorithm on a pr x pc process grid. On a square grid every process holds one block of A
+    and one of B, multiplies them and passes them on, q times.
+
+    On a rectangular grid the inner dimension is cut into L = lcm(pr, pc) panels.
+    Process (i, j) holds the panels k = j (mod pc) of row strip i of A and the panels k = i (mod pr)
+    of column strip j of B. These are blocks made of strided panels, so the usual skew and shifts
+    work unchanged: after the skew and s shifts, both blocks contain panel k = i + j + s (mod L),
+    which is multiplied. L steps cover every panel once.
+
+    N does not have to be divisible by anything: strips and panels are ragged (the first ones are one
+    larger), so the blocks that move around can change size from one shift to the next.
+    This part is already written for you below.
+
+    Args:
+        A, B: (N x N) matrices on rank 0, ignored on other ranks
+        dims: optional [pr, pc] shape of the process grid, see blocked_matrix_multiply
+        stats: optional dict, receives 'compute_time' (seconds in np.dot) and 'loop_time' (seconds of all steps)
+    """
     comm = MPI.COMM_WORLD
     
     rank = comm.Get_rank()
     size = comm.Get_size()
 
     n = N
-    q = int(np.sqrt(size))
-
-    # size must be a perfect square. q should divide n so that each process has the same size block.
-    assert q*q == size
-    assert n % q == 0
-
-    block_size = n // q
+    # The processes form a pr x pc grid, any number of processes works
+    pr, pc = MPI.Compute_dims(size, dims or [0, 0])
+    steps = math.lcm(pr, pc)
+
+    assert pr*pc == size
+
+    # Rows of A / C are split into pr strips, columns of B / C into pc strips and the inner dimension into steps panels
+    row_bounds = block_bounds(n, pr)
+    col_bounds = block_bounds(n, pc)
+    panel_bounds = block_bounds(n, steps)
+    heights = np.diff(row_bounds)
+    widths = np.diff(col_bounds)
+    panels = np.diff(panel_bounds)
+    # Width of the A block made of panels k = c (mod pc), and height of the B block made of panels k = r (mod pr)
+    A_widths = np.array([panels[c::pc].sum() for c in range(pc)], dtype=np.int64)
+    B_heights = np.array([panels[r::pr].sum() for r in range(pr)], dtype=np.int64)
 
     if rank == 0:
         if A is None or B is None:
@@ -26,13 +60,8 @@ def cannon_matrix_multiply(A, B, N):
 
     mat_dtype = comm.bcast(mat_dtype, root=0)
 
-    # Create local blocks. Each process receives a block_size * block_size square.
-    local_A = np.empty((block_size, block_size), dtype=mat_dtype)
-    local_B = np.empty((block_size, block_size), dtype=mat_dtype)
-    local_C = np.zeros((block_size, block_size), dtype=mat_dtype)
-
     # Define the Cartesian communicator. The processes are laid out into a 2D grid, the period indicates wrap-around.
-    dims = [q, q]
+    dims = [pr, pc]
     periods = [1, 1]
     comm_cart = comm.Create_cart(dims, periods, reorder=True)
 
@@ -40,36 +69,48 @@ def cannon_matrix_multiply(A, B, N):
     cart_rank = comm_cart.Get_rank()
     coords = comm_cart.Get_coords(cart_rank)
 
-    # Create blocks of A and B
+    # Create local blocks. A holds the panels k = j (mod pc) of row strip i, B the panels k = i (mod pr)
+    # of column strip j, C is a plain heights[i] x widths[j] block.
+    local_A = np.empty((heights[coords[0]], A_widths[coords[1]]), dtype=mat_dtype)
+    local_B = np.empty((B_heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+    local_C = np.zeros((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+
+    # Scatter blocks of A and B. Each block is described by a datatype, so MPI reads it in place out of A and B,
+    # without first copying the blocks one after another.
     if cart_rank == 0:
-        A_blocks = np.empty((size, block_size, block_size), dtype=A.dtype)
-        B_blocks = np.empty((size, block_size, block_size), dtype=B.dtype)
-        idx = 0
-        for i in range(q):
-            for j in range(q):
-                # These 2 lines create the blocks and ensure each block is contiguous so that they can be distributed
-                A_blocks[idx] = np.ascontiguousarray(A[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size])
-                B_blocks[idx] = np.ascontiguousarray(B[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size])
-                idx += 1
+        starts = panel_bounds[:-1]
+        A_types, B_types, C_types = [], [], []
+        for i in range(pr):
+            for j in range(pc):
+                # The panels k = j (mod pc) of row strip i of A and k = i (mod pr) of column strip j of B.
+                # On a square grid that is just block (i, j).
+                A_types.append(panel_type(mat_dtype, n, [row_bounds[i]], [heights[i]], starts[j::pc], panels[j::pc]))
+                B_types.append(panel_type(mat_dtype, n, starts[i::pr], panels[i::pr], [col_bounds[j]], [widths[j]]))
+                C_types.append(panel_type(mat_dtype, n, [row_bounds[i]], [heights[i]], [col_bounds[j]], [widths[j]]))
     else:
-        A_blocks = None
-        B_blocks = None
-
-    # TODO: Distribute the blocks of A and B to all other processes.
-    # This requires 1 MPI instruction for the A blocks and 1 MPI instruction for the B blocks
-
+        A_types, B_types, C_types = None, None, None
 
+    scatter_blocks(comm_cart, A, A_types, local_A)
+    scatter_blocks(comm_cart, B, B_types, local_B)
 
+    # Residue (mod pc) of the panels currently in local_A, and (mod pr) of the panels in local_B. Every shift brings in the next one.
+    A_residue = coords[1]
+    B_residue = coords[0]
 
     # These first 2 loops are to move the blocks to their starting positions 
     # First, shift blocks of A to the left.
-    # Hint for below: coords[0] is the row coordinate, coords[1] is the column coordinate
+    # Hint for below: coords[0] is the row coordinate, coords[1] is the column coordinate.
+    # A row of the grid has pc processes and a column has pr.
     for step in range(0):
         left_coords = (0, 0) # TODO: Calculate the coordinates of the left neighbor (to send to).
         right_coords = (0, 0) # TODO: Calculate the coordinates of the right neighbor (to receive from).
         left_rank = comm_cart.Get_cart_rank(left_coords)
         right_rank = comm_cart.Get_cart_rank(right_coords)
-        comm_cart.Sendrecv_replace(local_A, dest=left_rank, sendtag=0, source=right_rank, recvtag=0)
+        # The incoming block can have a different width, so it is received into a new buffer
+        A_residue = (A_residue + 1) % pc
+        recv_A = np.empty((heights[coords[0]], A_widths[A_residue]), dtype=mat_dtype)
+        comm_cart.Sendrecv(local_A, dest=left_rank, sendtag=0, recvbuf=recv_A, source=right_rank, recvtag=0)
+        local_A = recv_A
     
     # Second, shift blocks of B up.
     for step in range(0):
@@ -77,44 +118,89 @@ def cannon_matrix_multiply(A, B, N):
         down_coords = (0, 0) # TODO: Calculate the coordinates of the lower neighbor (to receive from).
         up_rank = comm_cart.Get_cart_rank(up_coords)
         down_rank = comm_cart.Get_cart_rank(down_coords)
-        comm_cart.Sendrecv_replace(local_B, dest=up_rank, sendtag=1, source=down_rank, recvtag=1)
+        B_residue = (B_residue + 1) % pr
+        recv_B = np.empty((B_heights[B_residue], widths[coords[1]]), dtype=mat_dtype)
+        comm_cart.Sendrecv(local_B, dest=up_rank, sendtag=1, recvbuf=recv_B, source=down_rank, recvtag=1)
+        local_B = recv_B
 
     # With the blocks shifted, the matrix multiplication can now proceed.
     # np.dot(A, B) performs the matrix multiplication for the blocks that are possessed. The resulting values are then added to the current C.
+    loop_start = MPI.Wtime()
+    compute_time = 0.0
     for step in range(0):
-        # Multiply and accumulate
-        local_C += np.dot(local_A, local_B)
+        # Multiply and accumulate the one panel both blocks have in common. Panel k starts after the panels
+        # k - pc, k - 2pc, ... in the A block and after k - pr, k - 2pr, ... in the B block (0 on a square grid, the whole block).
+        k = (coords[0] + coords[1] + step) % steps
+        a = panels[k % pc:k:pc].sum()
+        b = panels[k % pr:k:pr].sum()
+        compute_start = MPI.Wtime()
+        local_C += np.dot(local_A[:, a:a + panels[k]], local_B[b:b + panels[k]])
+        compute_time += MPI.Wtime() - compute_start
 
         # Shift the local block of A to the left.
         left_coords = 0 # TODO: Calculate the coordinates of the left neighbor (to send to).
         right_coords = 0 # TODO: Calculate the coordinates of the right neighbor (to receive from).
         left_rank = comm_cart.Get_cart_rank(left_coords)
         right_rank = comm_cart.Get_cart_rank(right_coords)
-        comm_cart.Sendrecv_replace(local_A, dest=left_rank, sendtag=2, source=right_rank, recvtag=2)
+        A_residue = (A_residue + 1) % pc
+        recv_A = np.empty((heights[coords[0]], A_widths[A_residue]), dtype=mat_dtype)
+        comm_cart.Sendrecv(local_A, dest=left_rank, sendtag=2,
+                           recvbuf=recv_A, source=right_rank, recvtag=2)
+        local_A = recv_A
 
         # Shift the local block of B up.
         up_coords = 0 # TODO: Calculate the coordinates of the upper neighbor (to send to).
         down_coords = 0 # TODO: Calculate the coordinates of the lower neighbor (to receive from).
         up_rank = comm_cart.Get_cart_rank(up_coords)
         down_rank = comm_cart.Get_cart_rank(down_coords)
-        comm_cart.Sendrecv_replace(local_B, dest=up_rank, sendtag=3, source=down_rank, recvtag=3)
-
-    # Send all local_C blocks to the root process.
-    collected_C = None
-    if cart_rank == 0:
-        collected_C = np.empty((size, block_size, block_size), dtype=local_C.dtype)
-    
-    # TODO: Add an MPI instruction to get all of the blocks back to the root (process 0).
+        B_residue = (B_residue + 1) % pr
+        recv_B = np.empty((B_heights[B_residue], widths[coords[1]]), dtype=mat_dtype)
+        comm_cart.Sendrecv(local_B, dest=up_rank, sendtag=3, recvbuf=recv_B, source=down_rank, recvtag=3)
+        local_B = recv_B
 
+    if stats is not None:
+        stats['compute_time'] = compute_time
+        stats['loop_time'] = MPI.Wtime() - loop_start
 
+    # Gather all local_C blocks back to the root process, every block goes straight to its place in the result matrix.
+    result = np.empty((n, n), dtype=local_C.dtype) if cart_rank == 0 else None
+    gather_blocks(comm_cart, local_C, result, C_types)
 
-    # Process 0 combines all of the block of C into 1 result matrix.
     if cart_rank == 0:
-        result = np.empty((n, n), dtype=local_C.dtype)
-        idx = 0
-        for i in range(q):
-            for j in range(q):
-                result[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size] = collected_C[idx]
-                idx += 1
-        return result
-    return None
+        free_types(A_types + B_types + C_types)
+    return result
+
+
+def cannon_matrix_multiply_overlap(A, B, N, dims=None, stats=None):
+    """
+    BONUS: cannon_matrix_multiply with the shifts overlapped with the multiplications, so a step takes
+    about max(compute, communication) instead of their sum.
+
+    TODO:
+        1. Set up the grid, blocks and initial skew as in cannon_matrix_multiply, but keep two buffers
+           each for A and B, large enough for any block that passes through this process.
+        2. At the start of every step (except the last), post Irecv of the next A and B blocks into the
+           spare buffers and Isend of the current ones to the left / upper neighbour.
+        3. Multiply the current panel while the messages travel, then Waitall and swap the buffers.
+        4. Fill stats['compute_time'] and stats['loop_time'] and gather C at the root as above.
+    """
+    raise NotImplementedError
+
+
+def panel_type(dtype, n, row_starts, row_lengths, col_starts, col_lengths):
+    """
+    Datatype that selects the rows in the ranges row_starts[r] ... row_starts[r]+row_lengths[r]-1 and, in each
+    of them, the columns in the ranges given by col_starts/col_lengths, out of an n x n matrix. The elements
+    come out row by row, the same order as a contiguous block of those rows and columns.
+    An empty selection gets None, like an empty block in block_types.
+    """
+    if not (sum(row_lengths) and sum(col_lengths)):
+        return None
+    base = dtlib.from_numpy_dtype(dtype)
+    # The selected columns of one row, resized to the extent of a full row so that rows can be indexed
+    row = base.Create_indexed([int(l) for l in col_lengths], [int(c) for c in col_starts])
+    full_row = row.Create_resized(0, n * base.extent)
+    block = full_row.Create_indexed([int(l) for l in row_lengths], [int(r) for r in row_starts]).Commit()
+    row.Free()
+    full_row.Free()
+    return block
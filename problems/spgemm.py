@@ -1,7 +1,22 @@
 from mpi4py import MPI
 import numpy as np
 
-def coo_spgemm(m, h, n, A, B):
+def coo_spgemm(m, h, n, A, B, row_range=None, b_bounds=None, stats=None, mask=None):
+    """
+    Args:
+        A: this process's nonzeros of A as a list of [i, k, a_ik]
+        B: this process's nonzeros of B as a list of [k, j, b_kj]
+        row_range: optional (start, stop). Rows of A are not assumed to be an even split,
+                   any contiguous block works; when given, only rows start <= i < stop are computed.
+        b_bounds: optional row bounds of B. BONUS: when given, fetch only the rows of B that this
+                  process's A uses from their owners instead of gathering all of B.
+        stats: optional dict, add the bytes received for B to stats['bytes_received']
+        mask: optional list of [i, j, w] for this process's rows of a mask (w is ignored).
+              BONUS: when given, only accumulate and return the c_ij at positions in the mask.
+
+    Returns:
+        C: nonzeros of this process's rows of C as a list of [i, j, c_ij], sorted by (i, j)
+    """
     comm = MPI.COMM_WORLD
 
     # TODO: Get entire matrix B onto each processor
@@ -23,11 +38,144 @@ def coo_spgemm(m, h, n, A, B):
                             c_{ij} = value
                         else
                             c_{ij} += value
+        Hint: keep each row of C in a dict keyed by j so finding c_{ij} does not need a scan,
+        and sort the row by j once when you write it to res.
     """
     res = None
 
     return res
 
 
-def csr_spgemm(m, h, n, A, B):
-    raise NotImplementedError
\ No newline at end of file
+def csr_spgemm(m, h, n, A, B, row_range=None, b_bounds=None, stats=None, mask=None, max_output_bytes=None, shared_b=False):
+    """
+    BONUS: Gustavson's algorithm using the compressed sparse row (CSR) format.
+
+    Args:
+        A: this process's nonzeros of A as an (nnz x 3) array (or list) of [i, k, a_ik]
+        B: this process's nonzeros of B as an (nnz x 3) array (or list) of [k, j, b_kj]
+        row_range: optional (start, stop) of the rows of A owned by this process
+        b_bounds, stats, mask: same as coo_spgemm
+        max_output_bytes: optional limit on the size of this process's C. BONUS: count the nonzeros
+                          of every row of C first (symbolic phase), raise MemoryError if C would
+                          not fit, otherwise allocate C once and fill it (numeric phase).
+        shared_b: BONUS: keep one CSR copy of all of B per node in an MPI shared-memory window
+                  (comm.Split_type(MPI.COMM_TYPE_SHARED) and MPI.Win.Allocate_shared, as in
+                  shared_array in blocked.py) instead of one per process. Ignores b_bounds.
+
+    Returns:
+        (indptr, indices, data): this process's rows of C in CSR format as numpy arrays. Row
+        row_range[0] + r has columns indices[indptr[r]:indptr[r + 1]] (sorted) and values
+        data[indptr[r]:indptr[r + 1]].
+
+    TODO:
+        1. Get entire matrix B onto each processor and build indptr/indices/data arrays for A and B.
+        2. For a batch of rows of A, expand every partial product a_{ik} * b_{kj} at once (no python
+           loop over rows): repeat each a_{ik} once per nonzero of row k of B.
+        3. Key every product by (row * n + j), sort the keys and sum the products with equal keys
+           with np.add.reduceat.
+        4. The distinct sorted keys are the rows and (sorted) columns of C, write them and their
+           sums into C's arrays.
+    """
+    raise NotImplementedError
+
+
+def stream_spgemm(m, h, n, A, B, path, memory_budget, row_range=None, b_bounds=None, stats=None, mask=None):
+    """
+    BONUS: out-of-core csr_spgemm. Compute this process's rows of C in batches that fit in
+    memory_budget bytes and write each batch to path before computing the next one.
+
+    Args:
+        path: output file shared by all processes. It holds the nonzeros of C as consecutive
+              int64 triples [i, j, c_ij] sorted by (i, j).
+        memory_budget: bytes one batch may use, for its rows of C and the partial products expanded to compute them
+        row_range, b_bounds, stats, mask: same as csr_spgemm
+
+    Returns:
+        (nnz, num_batches, largest_batch): nonzeros this process wrote, the number of batches and
+        the size in bytes of the largest batch
+
+    TODO:
+        1. Run the symbolic phase of csr_spgemm to get the number of nonzeros of every row of C,
+           expanding no more partial products at a time than fit in memory_budget.
+        2. Cut the rows into batches whose output plus expanded partial products fit in memory_budget.
+        3. Use comm.exscan on your nnz to find where your rows start in the file.
+        4. For each batch, run the numeric phase and write the triples with MPI.File.Write_at.
+    """
+    raise NotImplementedError
+
+
+def dynamic_spgemm(m, h, n, A, B, chunk_size=64, stats=None):
+    """
+    BONUS: csr_spgemm with dynamic scheduling. Instead of a fixed block of rows per process,
+    processes take chunks of chunk_size rows from a shared counter until every row is done.
+
+    Args:
+        A: this process's nonzeros of A as an (nnz x 3) array (or list) of [i, k, a_ik], any distribution
+        B: this process's nonzeros of B as an (nnz x 3) array (or list) of [k, j, b_kj], any distribution
+        chunk_size: rows handed out per request, at least 1 (0 would never move the counter)
+        stats: optional dict, set stats['busy_time'] to the seconds spent computing chunks
+               and stats['chunks'] to their number
+
+    Returns:
+        C: nonzeros of the rows of C this process computed as an (nnz x 3) int64 array of
+           [i, j, c_ij], sorted by (i, j)
+
+    TODO:
+        1. Get all of A and B onto each processor, any processor may be handed any row.
+        2. Allocate an MPI.Win (MPI.Win.Allocate) holding one int64 counter on rank 0, and zero it before use.
+        3. Loop: Fetch_and_op(chunk_size) on the counter gives the first row of your next chunk.
+           Stop once it is >= m, otherwise compute those rows with the CSR kernel.
+    """
+    raise NotImplementedError
+
+
+def spsumma_spgemm(m, h, n, A, B, row_range=None, stats=None):
+    """
+    BONUS: 2D Sparse SUMMA on a pr x pc process grid from MPI.Compute_dims, using the same Create_cart
+    and row/column Split setup as blocked_matrix_multiply.
+
+    Args:
+        A: this process's nonzeros of A as an (nnz x 3) array (or list) of [i, k, a_ik]
+        B: this process's nonzeros of B as an (nnz x 3) array (or list) of [k, j, b_kj]
+        row_range: (start, stop) of the rows of C this process returns
+        stats: optional dict, add the bytes received in the broadcasts to stats['bytes_received']
+
+    Returns:
+        C: nonzeros of rows start <= i < stop of C as an (nnz x 3) int64 array of [i, j, c_ij], sorted by (i, j)
+
+    TODO:
+        1. Move every nonzero of A and B to the process that owns its 2D block, and store each
+           block in CSR format.
+        2. The inner dimension is split into pc blocks of columns of A but pr blocks of rows of B.
+           Cut it into panels at the edges of both, and for each panel broadcast its columns of A
+           along the grid rows and its rows of B along the grid columns, then multiply the two
+           panels you received.
+        3. Merge (sum) the partial products of all stages.
+        4. Send every row of C back to the process whose row_range holds it.
+    """
+    raise NotImplementedError
+
+
+def gram_spgemm(m, h, A, row_range=None, mirror=True, stats=None):
+    """
+    BONUS: C = A * A^T using only A. C is symmetric, so compute only the upper triangle (j >= i)
+    and mirror it.
+
+    Args:
+        A: this process's nonzeros of A (m x h) as an (nnz x 3) array (or list) of [i, k, a_ik]
+        row_range: optional (start, stop) of the rows of A owned by this process
+        mirror: if False, return only the upper triangle (j >= i) of this process's rows
+        stats: optional dict, add the bytes received for A to stats['bytes_received']
+
+    Returns:
+        C: nonzeros of this process's rows of C as an (nnz x 3) int64 array of [i, j, c_ij], sorted by (i, j)
+
+    TODO:
+        1. Get the columns of A (each with its rows sorted) onto each processor. Column k of A is row k of A^T.
+        2. For each row i and each nonzero a_{ik}, add a_{ik} * a_{jk} to c_{ij} only for the rows j >= i of column k.
+           a_{ik} is itself the entry of row i in column k, so the rows j >= i start at its own position
+           in the sorted column. As in csr_spgemm, do this for a batch of rows at once: expand the
+           products, key them by (i, j) and sum equal keys.
+        3. Send every c_{ij} with j > i to the process owning row j as c_{ji}.
+    """
+    raise NotImplementedError
@@ -33,12 +33,64 @@ if [ "$1" == "spgemm_opt" ]; then
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm2
 fi
 
+if [ "$1" == "spsumma" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o spsumma
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spsumma
+fi
+
+if [ "$1" == "gram" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o gram
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o gram
+fi
+
+if [ "$1" == "masked" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o masked
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o masked
+fi
+
+if [ "$1" == "stream" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o stream
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input2.txt -o stream --memory-budget 256
+fi
+
+if [ "$1" == "reorder" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm2
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm2 --reorder degree
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm2 --reorder rcm
+fi
+
+if [ "$1" == "schedule" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm2 --schedule static
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm2 --schedule dynamic
+fi
+
+if [ "$1" == "shared" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm2 --shared-memory
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o blocked --shared-memory
+fi
+
+if [ "$1" == "bitpack" ]; then
+    mpiexec -n 1 python main.py -f tests/input1.txt -o brute --bitpack
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o blocked --bitpack
+fi
+
+if [ "$1" == "summa" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o blocked
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o blocked --summa
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o blocked --summa --panel-width 64
+fi
+
+if [ "$1" == "overlap" ]; then
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o cannon
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o cannon --overlap
+fi
+
 if [ "$1" == "test_all_small" ]; then
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o brute
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o blocked
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o cannon
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o spgemm1
-    # mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o spgemm2
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o spgemm2
 fi
 
 if [ "$1" == "test_all_med" ]; then
@@ -46,7 +98,7 @@ if [ "$1" == "test_all_med" ]; then
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o blocked
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o cannon
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm1
-    # mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o spgemm2
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input1.txt -o spgemm2
 fi
 
 if [ "$1" == "test_all_large" ]; then
@@ -54,5 +106,5 @@ if [ "$1" == "test_all_large" ]; then
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input2.txt -o blocked
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input2.txt -o cannon
     mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input2.txt -o spgemm1
-    # mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input.txt -o spgemm2
+    mpiexec -n "$SLURM_NTASKS_PER_NODE" python main.py -f tests/input2.txt -o spgemm2
 fi
\ No newline at end of file
@@ -0,0 +1,100 @@
+from mpi4py import MPI
+import numpy as np
+
+from solutions.blocked_sol import block_bounds, block_types, free_types, gather_blocks
+
+# Set bits of every byte value, for numpy versions without np.bitwise_count
+POPCOUNT_TABLE = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    # Number of set bits in every uint64, np.bitwise_count needs numpy >= 2.0
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def bitpacked_multiply(A_bits, B_T_bits, chunk_bytes=1 << 25):
+    """
+    Boolean matrix product with counts, for 0/1 matrices stored as bitsets. Bit k of row i is
+    set when a_ik = 1, so c_ij = sum_k a_ik * b_kj = popcount(row i of A & row j of B^T).
+
+    Args:
+        A_bits: (m x w) uint64 array, the rows of A packed 64 columns per word
+        B_T_bits: (n x w) uint64 array, the rows of B^T (columns of B) packed the same way
+        chunk_bytes: rows of A are processed in chunks whose (rows x n x w) temporary is about this size
+
+    Returns:
+        C: (m x n) int32 matrix of counts
+    """
+    m, w = A_bits.shape
+    n = B_T_bits.shape[0]
+    C = np.empty((m, n), dtype=np.int32)
+    rows_per_chunk = max(1, chunk_bytes // max(1, n * w * 8))
+    for lo in range(0, m, rows_per_chunk):
+        hi = min(lo + rows_per_chunk, m)
+        # (rows, 1, w) & (1, n, w): every row of the chunk against every column of B at once
+        both = A_bits[lo:hi, None, :] & B_T_bits[None, :, :]
+        C[lo:hi] = popcount(both).sum(axis=2, dtype=np.int32)
+    return C
+
+
+def blocked_bitpacked_multiply(A_bits, B_T_bits, N, dims=None):
+    """
+    Distributed bitpacked_multiply on the same pr x pc grid as blocked_matrix_multiply. Process (i, j)
+    computes block C_ij, which only needs row block i of A and row block j of B^T: all of their words,
+    so no partial sums are exchanged. The packed blocks are 64x smaller than float64 ones.
+
+    Args:
+        A_bits, B_T_bits: (N x w) packed matrices on rank 0, ignored on other ranks. Blocks are ragged when pr or pc does not divide N.
+        dims: optional [pr, pc] shape of the process grid, see blocked_matrix_multiply
+
+    Returns:
+        C: (N x N) int32 matrix of counts on rank 0, None elsewhere
+    """
+    comm = MPI.COMM_WORLD
+
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    n = N
+    pr, pc = MPI.Compute_dims(size, dims or [0, 0])
+    assert pr*pc == size
+
+    # Ragged blocks as in blocked_matrix_multiply
+    row_bounds = block_bounds(n, pr)
+    col_bounds = block_bounds(n, pc)
+    heights = np.diff(row_bounds)
+    widths = np.diff(col_bounds)
+    words = comm.bcast(A_bits.shape[1] if rank == 0 else None, root=0)
+
+    dims = [pr, pc]
+    periods = [1, 1]
+    comm_cart = comm.Create_cart(dims, periods, reorder=True)
+    cart_rank = comm_cart.Get_rank()
+    coords = comm_cart.Get_coords(cart_rank)
+
+    # Process (i, j) gets row block i of A and row block j of B^T, so each block of A is sent pc times
+    # and each block of B^T pr times.
+    # Row blocks are contiguous in the packed matrices, so the displacements point straight into them, no copies.
+    A_counts = np.repeat(heights, pc) * words
+    B_counts = np.tile(widths, pr) * words
+    A_displs = np.repeat(row_bounds[:-1], pc) * words
+    B_displs = np.tile(col_bounds[:-1], pr) * words
+
+    local_A = np.empty((heights[coords[0]], words), dtype=np.uint64)
+    local_B = np.empty((widths[coords[1]], words), dtype=np.uint64)
+    comm_cart.Scatterv([A_bits, (A_counts, A_displs)] if cart_rank == 0 else None, local_A, root=0)
+    comm_cart.Scatterv([B_T_bits, (B_counts, B_displs)] if cart_rank == 0 else None, local_B, root=0)
+
+    local_C = bitpacked_multiply(local_A, local_B)
+
+    # Blocks of C go straight to their place in the result, as in blocked_matrix_multiply
+    types = block_types(local_C.dtype, n, row_bounds, col_bounds) if cart_rank == 0 else None
+    result = np.empty((n, n), dtype=local_C.dtype) if cart_rank == 0 else None
+    gather_blocks(comm_cart, local_C, result, types)
+
+    if cart_rank == 0:
+        free_types(types)
+    return result
+
@@ -1,20 +1,31 @@
 from mpi4py import MPI
+from mpi4py.util import dtlib
 import numpy as np
 
-def blocked_matrix_multiply(A, B, N):
+def blocked_matrix_multiply(A, B, N, dims=None):
+    """
+    Args:
+        A, B: (N x N) matrices on rank 0, ignored on other ranks. N can be anything, blocks are ragged
+              when pr or pc does not divide it.
+        dims: optional [pr, pc] shape of the process grid, pr * pc must equal the number of processes.
+              Entries left as 0 (or dims=None) are chosen by MPI.Compute_dims, as square as possible.
+    """
     comm = MPI.COMM_WORLD
 
     rank = comm.Get_rank()
     size = comm.Get_size()
 
     n = N
-    q = int(np.sqrt(size))
+    # The processes form a pr x pc grid, any number of processes works
+    pr, pc = MPI.Compute_dims(size, dims or [0, 0])
+    assert pr*pc == size
 
-    # size must be a perfect square. q should divide n so that each process has the same size block.
-    assert q*q == size
-    assert n % q == 0
-
-    block_size = n // q
+    # Block row i is rows row_bounds[i] ... row_bounds[i+1]-1, block column j is cols col_bounds[j] ... col_bounds[j+1]-1.
+    # When n is not divisible, the first blocks are one larger, so no padding is needed.
+    row_bounds = block_bounds(n, pr)
+    col_bounds = block_bounds(n, pc)
+    heights = np.diff(row_bounds)
+    widths = np.diff(col_bounds)
 
     if rank == 0:
         if A is None or B is None:
@@ -26,13 +37,8 @@ def blocked_matrix_multiply(A, B, N):
 
     mat_dtype = comm.bcast(mat_dtype, root=0)
 
-    # Create local blocks. Each process receives a block_size * block_size square.
-    local_A = np.empty((block_size, block_size), dtype=mat_dtype)
-    local_B = np.empty((block_size, block_size), dtype=mat_dtype)
-    local_C = np.zeros((block_size, block_size), dtype=mat_dtype)
-
     # Define the Cartesian communicator. The processes are laid out into a 2D grid, the period indicates wrap-around.
-    dims = [q, q]
+    dims = [pr, pc]
     periods = [1, 1]
     comm_cart = comm.Create_cart(dims, periods, reorder=True)
 
@@ -40,53 +46,329 @@ def blocked_matrix_multiply(A, B, N):
     cart_rank = comm_cart.Get_rank()
     coords = comm_cart.Get_coords(cart_rank)
 
-    # Scatter blocks of A and B
-    if cart_rank == 0:
-        A_blocks = np.empty((size, block_size, block_size), dtype=A.dtype)
-        B_blocks = np.empty((size, block_size, block_size), dtype=B.dtype)
-        idx = 0
-        for i in range(q):
-            for j in range(q):
-                # These 2 lines create the blocks and ensure each block is contiguous so that they can be scattered
-                A_blocks[idx] = np.ascontiguousarray(A[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size])
-                B_blocks[idx] = np.ascontiguousarray(B[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size])
-                idx += 1
-    else:
-        A_blocks = None
-        B_blocks = None
+    # Create local blocks. Process (i, j) receives a heights[i] * widths[j] block.
+    local_A = np.empty((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+    local_B = np.empty((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+    local_C = np.zeros((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
 
-    comm_cart.Scatter(A_blocks, local_A, root=0)
-    comm_cart.Scatter(B_blocks, local_B, root=0)
+    # Scatter blocks of A and B. Each block is described by a datatype, so MPI reads it in place out of A and B,
+    # without first copying the blocks one after another. A, B and C all use the same blocks.
+    types = block_types(mat_dtype, n, row_bounds, col_bounds) if cart_rank == 0 else None
+    scatter_blocks(comm_cart, A, types, local_A)
+    scatter_blocks(comm_cart, B, types, local_B)
 
     # Create subcommunicators along the rows and columns.
     row_comm = comm_cart.Split(color=coords[0], key=coords[1])
     col_comm = comm_cart.Split(color=coords[1], key=coords[0])
-    
-    # Each process in a row collects all A blocks in that row and B blocks in the column
-    row_A_blocks = np.empty((q, block_size, block_size), dtype=local_A.dtype)
-    row_comm.Allgather(local_A, row_A_blocks)
-    
-    col_B_blocks = np.empty((q, block_size, block_size), dtype=local_B.dtype)
-    col_comm.Allgather(local_B, col_B_blocks)
-    
+
+    # Each process in a row collects all A blocks in that row (pc of them) and B blocks in the column (pr of them)
+    row_counts = heights[coords[0]] * widths
+    row_displs = np.cumsum(row_counts) - row_counts
+    row_A_blocks = np.empty(n * heights[coords[0]], dtype=local_A.dtype)
+    row_comm.Allgatherv(local_A, [row_A_blocks, (row_counts, row_displs)])
+
+    # The column blocks stacked on top of each other are the whole column strip of B (n x widths[j]).
+    col_counts = heights * widths[coords[1]]
+    col_displs = np.cumsum(col_counts) - col_counts
+    col_B_strip = np.empty((n, widths[coords[1]]), dtype=local_B.dtype)
+    col_comm.Allgatherv(local_B, [col_B_strip, (col_counts, col_displs)])
+
     # Compute local C as:
-    # C_{ij} = sum_{k=0}^{q-1} A_{ik} * B_{kj}
-    for k in range(q):
-        local_C += np.dot(row_A_blocks[k], col_B_blocks[k])
+    # C_{ij} = sum_{k=0}^{pc-1} A_{ik} * B_{kj}, where A_{ik} is the k-th gathered block of the row and
+    # B_{kj} the rows col_bounds[k] ... col_bounds[k+1]-1 of the strip, the same inner indices
+    for k in range(pc):
+        A_ik = row_A_blocks[row_displs[k]:row_displs[k] + row_counts[k]].reshape(heights[coords[0]], widths[k])
+        local_C += np.dot(A_ik, col_B_strip[col_bounds[k]:col_bounds[k+1]])
+
+    # Gather C at the root, every block goes straight to its place in the result matrix
+    result = np.empty((n, n), dtype=local_C.dtype) if cart_rank == 0 else None
+    gather_blocks(comm_cart, local_C, result, types)
+
+    if cart_rank == 0:
+        free_types(types)
+    return result
+
+
+def summa_matrix_multiply(A, B, N, dims=None, panel_width=None, stats=None):
+    """
+    SUMMA on the same pr x pc grid and blocks as blocked_matrix_multiply. Instead of allgathering whole row
+    and column strips, the inner dimension is cut into panels; in every stage the owner of the panel
+    broadcasts its columns of A along its grid row and its rows of B along its grid column, and every
+    process accumulates local_C += A_panel @ B_panel. The broadcast of the next panel is posted with Ibcast
+    into a second pair of buffers before the current panel is multiplied, so it overlaps the np.dot.
+    Each process only holds its blocks and two panels of A and B, O(b^2) however large the grid is.
+
+    Args:
+        A, B: (N x N) matrices on rank 0, ignored on other ranks
+        dims: optional [pr, pc] shape of the process grid, see blocked_matrix_multiply
+        panel_width: maximum number of columns of A (rows of B) per stage, defaults to the width of a block
+        stats: optional dict, receives 'panels' and 'buffer_bytes' (bytes of the panel buffers on this process)
+    """
+    comm = MPI.COMM_WORLD
+
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    n = N
+    pr, pc = MPI.Compute_dims(size, dims or [0, 0])
+    assert pr*pc == size
+
+    # Ragged blocks as in blocked_matrix_multiply
+    row_bounds = block_bounds(n, pr)
+    col_bounds = block_bounds(n, pc)
+    heights = np.diff(row_bounds)
+    widths = np.diff(col_bounds)
+
+    if rank == 0:
+        if A is None or B is None:
+            mat_dtype = np.float64
+        else:
+            mat_dtype = A.dtype
+    else:
+        mat_dtype = None
+
+    mat_dtype = comm.bcast(mat_dtype, root=0)
+
+    dims = [pr, pc]
+    periods = [1, 1]
+    comm_cart = comm.Create_cart(dims, periods, reorder=True)
+    cart_rank = comm_cart.Get_rank()
+    coords = comm_cart.Get_coords(cart_rank)
+
+    local_A = np.empty((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+    local_B = np.empty((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+    local_C = np.zeros((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+
+    types = block_types(mat_dtype, n, row_bounds, col_bounds) if cart_rank == 0 else None
+    scatter_blocks(comm_cart, A, types, local_A)
+    scatter_blocks(comm_cart, B, types, local_B)
+
+    # The rank in row_comm is the column coordinate and the rank in col_comm the row coordinate
+    row_comm = comm_cart.Split(color=coords[0], key=coords[1])
+    col_comm = comm_cart.Split(color=coords[1], key=coords[0])
+
+    # The inner index k is split into blocks of columns of A by col_bounds, but into blocks of rows of B by row_bounds.
+    # A panel must not cross either, so it lies inside one block of each, then it is cut to at most panel_width.
+    if panel_width is None:
+        panel_width = max(1, -(-n // max(pr, pc)))
+    edges = np.union1d(row_bounds, col_bounds)
+    panels = [(lo, min(lo + panel_width, hi)) for lo, hi in zip(edges[:-1], edges[1:]) for lo in range(lo, hi, panel_width)]
+
+    # Two buffers for each, the stage being multiplied and the one being broadcast, sized for the widest panel
+    h, w = local_C.shape
+    widest = max((hi - lo for lo, hi in panels), default=0)
+    A_bufs = [np.empty(h * widest, dtype=mat_dtype) for _ in range(2)]
+    B_bufs = [np.empty(widest * w, dtype=mat_dtype) for _ in range(2)]
+
+    def post(stage):
+        # Starts the broadcasts of panel stage into buffer pair stage % 2, the owners copy their part in first
+        lo, hi = panels[stage]
+        owner_col = np.searchsorted(col_bounds, lo, side='right') - 1
+        owner_row = np.searchsorted(row_bounds, lo, side='right') - 1
+        A_panel = A_bufs[stage % 2][:h * (hi - lo)].reshape(h, hi - lo)
+        B_panel = B_bufs[stage % 2][:(hi - lo) * w].reshape(hi - lo, w)
+        if coords[1] == owner_col:
+            A_panel[...] = local_A[:, lo - col_bounds[owner_col]:hi - col_bounds[owner_col]]
+        if coords[0] == owner_row:
+            B_panel[...] = local_B[lo - row_bounds[owner_row]:hi - row_bounds[owner_row]]
+        requests = [row_comm.Ibcast(A_panel, root=owner_col), col_comm.Ibcast(B_panel, root=owner_row)]
+        return A_panel, B_panel, requests
+
+    pending = post(0) if panels else None
+    for stage in range(len(panels)):
+        A_panel, B_panel, requests = pending
+        MPI.Request.Waitall(requests)
+        # The next panel is on its way while this one is multiplied
+        if stage + 1 < len(panels):
+            pending = post(stage + 1)
+        local_C += np.dot(A_panel, B_panel)
+
+    if stats is not None:
+        stats['panels'] = len(panels)
+        stats['buffer_bytes'] = sum(buf.nbytes for buf in A_bufs + B_bufs)
+
+    row_comm.Free()
+    col_comm.Free()
+
+    # Gather C at the root, in place as in blocked_matrix_multiply
+    result = np.empty((n, n), dtype=local_C.dtype) if cart_rank == 0 else None
+    gather_blocks(comm_cart, local_C, result, types)
 
-    # Gather C at the root
-    collected_C = None
     if cart_rank == 0:
-        collected_C = np.empty((size, block_size, block_size), dtype=local_C.dtype)
-    comm_cart.Gather(local_C, collected_C, root=0)
+        free_types(types)
+    return result
+
+
+def block_bounds(n, parts):
+    # Splits n rows/cols into parts contiguous blocks, the first (n % parts) blocks get one extra
+    counts = np.full(parts, n // parts, dtype=np.int64)
+    counts[:n % parts] += 1
+    bounds = np.zeros(parts + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    return bounds
+
+
+def block_types(dtype, n, row_bounds, col_bounds):
+    # One datatype per block (i, j), in cart_rank (row-major) order, that selects the block inside an n x n matrix.
+    # MPI does not allow empty subarrays, so empty blocks get None and are sent as 0 elements.
+    base = dtlib.from_numpy_dtype(dtype)
+    types = []
+    for i in range(len(row_bounds) - 1):
+        for j in range(len(col_bounds) - 1):
+            shape = [int(row_bounds[i+1] - row_bounds[i]), int(col_bounds[j+1] - col_bounds[j])]
+            if shape[0] and shape[1]:
+                types.append(base.Create_subarray([n, n], shape, [int(row_bounds[i]), int(col_bounds[j])]).Commit())
+            else:
+                types.append(None)
+    return types
+
+
+def free_types(types):
+    for t in types:
+        if t is not None:
+            t.Free()
+
+
+def scatter_blocks(comm, M, types, local, root=0):
+    """
+    Scatterv with a different datatype per process: process r receives the part of M (on the root)
+    selected by types[r] into the contiguous array local. Scatterv only takes one datatype, which
+    cannot describe ragged or strided blocks, so this is an Alltoallw in which only the root sends.
+    """
+    size = comm.Get_size()
+    base = dtlib.from_numpy_dtype(local.dtype)
+    zeros = [0] * size
+    recv_counts = [local.size if r == root else 0 for r in range(size)]
+    if comm.Get_rank() == root:
+        send = [M, ([int(t is not None) for t in types], zeros), [t or base for t in types]]
+    else:
+        send = [local, (zeros, zeros), [base] * size]
+    comm.Alltoallw(send, [local, (recv_counts, zeros), [base] * size])
+
+
+def gather_blocks(comm, local, M, types, root=0):
+    # The reverse of scatter_blocks: local of process r is written into the part of M (on the root) selected by types[r]
+    size = comm.Get_size()
+    base = dtlib.from_numpy_dtype(local.dtype)
+    zeros = [0] * size
+    send_counts = [local.size if r == root else 0 for r in range(size)]
+    if comm.Get_rank() == root:
+        recv = [M, ([int(t is not None) for t in types], zeros), [t or base for t in types]]
+    else:
+        recv = [local, (zeros, zeros), [base] * size]
+    comm.Alltoallw([local, (send_counts, zeros), [base] * size], recv)
+
+
+def blocked_matrix_multiply_shared(A, B, N, dims=None):
+    """
+    blocked_matrix_multiply with one copy per node of the strips of A and B its processes use, instead of
+    a strip of each per process. The processes of a node share a window from Win.Allocate_shared that
+    holds only the union of their row strips of A and of their column strips of B; only the first process
+    of every node receives those strips from the root, and the others read the row panel of A and the
+    column panel of B they need straight from that memory. Memory per node no longer grows with the
+    processes per node, and is below the full N x N matrices whenever a node does not span the whole grid.
+    """
+    comm = MPI.COMM_WORLD
+
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    n = N
+    pr, pc = MPI.Compute_dims(size, dims or [0, 0])
+    assert pr*pc == size
+
+    # Ragged blocks as in blocked_matrix_multiply
+    row_bounds = block_bounds(n, pr)
+    col_bounds = block_bounds(n, pc)
+    heights = np.diff(row_bounds)
+    widths = np.diff(col_bounds)
+
+    if rank == 0:
+        if A is None or B is None:
+            mat_dtype = np.float64
+        else:
+            mat_dtype = A.dtype
+    else:
+        mat_dtype = None
+
+    mat_dtype = comm.bcast(mat_dtype, root=0)
+
+    dims = [pr, pc]
+    periods = [1, 1]
+    comm_cart = comm.Create_cart(dims, periods, reorder=True)
+    cart_rank = comm_cart.Get_rank()
+    coords = comm_cart.Get_coords(cart_rank)
+
+    local_C = np.zeros((heights[coords[0]], widths[coords[1]]), dtype=mat_dtype)
+
+    # Processes that can share memory, and one leader per node to move data between nodes.
+    # Split_type keeps the cart_rank order, so cart_rank 0 leads its node and is rank 0 among the leaders.
+    node_comm = comm_cart.Split_type(MPI.COMM_TYPE_SHARED)
+    leader = node_comm.Get_rank() == 0
+    leader_comm = comm_cart.Split(0 if leader else MPI.UNDEFINED, cart_rank)
+
+    # Row strips of A and column strips of B used on this node, stacked in the node's arrays in this order
+    node_coords = node_comm.allgather(coords)
+    node_rows = sorted({c[0] for c in node_coords})
+    node_cols = sorted({c[1] for c in node_coords})
+    row_offsets = dict(zip(node_rows, np.cumsum([0] + [int(heights[i]) for i in node_rows])))
+    col_offsets = dict(zip(node_cols, np.cumsum([0] + [int(widths[j]) for j in node_cols])))
+    total_width = int(sum(widths[j] for j in node_cols))
+
+    shared_A, win_A = shared_array(node_comm, (int(sum(heights[i] for i in node_rows)), n), mat_dtype)
+    shared_B, win_B = shared_array(node_comm, (n, total_width), mat_dtype)
+    if leader:
+        base = dtlib.from_numpy_dtype(mat_dtype)
+        wanted = leader_comm.gather((node_rows, node_cols), root=0)
+        requests, types = [], []
+        if cart_rank == 0:
+            # A row strip is contiguous, a column strip of B is sent with a subarray type
+            for dest, (want_rows, want_cols) in enumerate(wanted):
+                for i in want_rows:
+                    if heights[i] and n:
+                        requests.append(leader_comm.Isend(A[row_bounds[i]:row_bounds[i+1]], dest, tag=0))
+                for j in want_cols:
+                    if widths[j] and n:
+                        types.append(base.Create_subarray([n, n], [n, int(widths[j])], [0, int(col_bounds[j])]).Commit())
+                        requests.append(leader_comm.Isend([B, 1, types[-1]], dest, tag=1))
+        for i in node_rows:
+            if heights[i] and n:
+                leader_comm.Recv(shared_A[row_offsets[i]:row_offsets[i] + heights[i]], source=0, tag=0)
+        for j in node_cols:
+            if widths[j] and n:
+                types.append(base.Create_subarray([n, total_width], [n, int(widths[j])], [0, int(col_offsets[j])]).Commit())
+                leader_comm.Recv([shared_B, 1, types[-1]], source=0, tag=1)
+        MPI.Request.Waitall(requests)
+        free_types(types)
+        leader_comm.Free()
+    # Nobody reads A or B before the leader has written them
+    node_comm.Barrier()
+
+    # C_{ij} = sum_{k=0}^{pc-1} A_{ik} * B_{kj}, with the blocks read in place
+    row_strip = shared_A[row_offsets[coords[0]]:row_offsets[coords[0]] + heights[coords[0]]]
+    col_strip = shared_B[:, col_offsets[coords[1]]:col_offsets[coords[1]] + widths[coords[1]]]
+    for k in range(pc):
+        inner = slice(col_bounds[k], col_bounds[k+1])
+        local_C += np.dot(row_strip[:, inner], col_strip[inner])
+
+    win_A.Free()
+    win_B.Free()
+    node_comm.Free()
+
+    # Gather C at the root, in place as in blocked_matrix_multiply
+    types = block_types(mat_dtype, n, row_bounds, col_bounds) if cart_rank == 0 else None
+    result = np.empty((n, n), dtype=local_C.dtype) if cart_rank == 0 else None
+    gather_blocks(comm_cart, local_C, result, types)
 
     if cart_rank == 0:
-        # Reassemble the full result matrix from gathered blocks.
-        result = np.empty((n, n), dtype=local_C.dtype)
-        idx = 0
-        for i in range(q):
-            for j in range(q):
-                result[i*block_size:(i+1)*block_size, j*block_size:(j+1)*block_size] = collected_C[idx]
-                idx += 1
-        return result
-    return None
+        free_types(types)
+    return result
+
+
+def shared_array(node_comm, shape, dtype):
+    # One array per node: the node's first process allocates a shared window, the others map its memory
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize if node_comm.Get_rank() == 0 else 0
+    win = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=node_comm)
+    buf, _ = win.Shared_query(0)
+    return np.ndarray(buffer=buf, dtype=dtype, shape=shape), win
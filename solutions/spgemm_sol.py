@@ -2,12 +2,32 @@ import mpi4py
 from mpi4py import MPI
 import numpy as np
 
-def coo_spgemm(m, h, n, A, B):
+from solutions.blocked_sol import block_bounds, shared_array
+
+def coo_spgemm(m, h, n, A, B, row_range=None, b_bounds=None, stats=None, mask=None):
+    """
+    Args:
+        A: this process's nonzeros of A as a list of [i, k, a_ik]
+        B: this process's nonzeros of B as a list of [k, j, b_kj]
+        row_range: optional (start, stop). Rows of A are not assumed to be an even split,
+                   any contiguous block works; when given, only rows start <= i < stop are computed.
+        b_bounds: optional row bounds of B, process r holds rows [b_bounds[r], b_bounds[r + 1]).
+                  When given, only the rows of B used by this process's A are fetched (see
+                  fetch_b_rows) instead of gathering all of B.
+        stats: optional dict, 'bytes_received' is increased by the bytes this process received for B
+        mask: optional list of [i, j, w] for this process's rows of a mask (w is ignored). When given,
+              only the c_ij at positions present in the mask are accumulated and returned.
+
+    Returns:
+        C: nonzeros of this process's rows of C as a list of [i, j, c_ij], sorted by (i, j)
+    """
     comm = MPI.COMM_WORLD
 
-    # TODO: Get entire matrix B onto each processor
-    fullB = comm.allgather(B)
-    fullB = [item for sublist in fullB for item in sublist]
+    # Get entire matrix B onto each processor, or only the rows this processor needs
+    if b_bounds is None:
+        fullB = allgather_entries(comm, B, stats).tolist()
+    else:
+        fullB = fetch_b_rows(comm, [A_nnz[1] for A_nnz in A], B, b_bounds, stats).tolist()
 
     """
     TODO: Spgemm Algorithm
@@ -24,6 +44,8 @@ def coo_spgemm(m, h, n, A, B):
     matrix_A = dict()
     matrix_B = dict()
     for A_nnz in A:
+        if row_range is not None and not row_range[0] <= A_nnz[0] < row_range[1]:
+            continue
         if A_nnz[0] in matrix_A:
             matrix_A[A_nnz[0]].append((A_nnz[1], A_nnz[2]))
         else:
@@ -34,30 +56,844 @@ def coo_spgemm(m, h, n, A, B):
         else:
             matrix_B[B_nnz[0]] = [(B_nnz[1], B_nnz[2])]
 
+    # With a mask, rows of A without mask entries are skipped and only masked c_ij are kept
+    matrix_M = None
+    if mask is not None:
+        matrix_M = dict()
+        for M_nnz in mask:
+            matrix_M.setdefault(M_nnz[0], set()).add(M_nnz[1])
+
+    # Each row of C is accumulated in a dict keyed by j, so adding a partial product is O(1)
+    # instead of a scan over the entries already in the row. The row is sorted once when emitted.
     matrix_C = dict()
     for keyA, valA in sorted(matrix_A.items()):
-        C_key = keyA
+        if matrix_M is not None and keyA not in matrix_M:
+            continue
+        row_M = matrix_M[keyA] if matrix_M is not None else None
+        row_C = matrix_C.setdefault(keyA, dict())
         for (k, wA) in valA:
-            for (j, wB) in matrix_B[k]:
-                val = wA * wB
-                if C_key not in matrix_C:
-                    matrix_C[C_key] = [(j, val)]
-                else:
-                    find_cij = False
-                    for idx, (cij_j, cij_val) in enumerate(matrix_C[C_key]):
-                        if cij_j == j:
-                            matrix_C[C_key][idx] = (j, cij_val + val)
-                            find_cij = True
-                    if not find_cij:
-                        matrix_C[C_key].append((j, val))
-    
+            for (j, wB) in matrix_B.get(k, ()):
+                if row_M is not None and j not in row_M:
+                    continue
+                row_C[j] = row_C.get(j, 0) + wA * wB
+
     res = []
     for keyC, valC in sorted(matrix_C.items()):
-        valC.sort(key=lambda tup: tup[0])
-        for v in valC:
-            res.append([keyC, v[0], v[1]])
+        for j in sorted(valC):
+            res.append([keyC, j, valC[j]])
     return res
 
 
-def csr_spgemm(m, h, n, A, B):
-    raise NotImplementedError
\ No newline at end of file
+def build_csr(entries, first_row, num_rows):
+    """
+    Args:
+        entries: nonzeros as a list of [i, j, w] or an (nnz x 3) integer array
+        first_row: global index of the first row stored
+        num_rows: number of rows stored, rows first_row ... first_row + num_rows - 1
+
+    Returns:
+        (indptr, indices, data): row i's nonzeros are indices/data[indptr[i - first_row]:indptr[i - first_row + 1]]
+    """
+    entries = np.asarray(entries, dtype=np.int64).reshape(-1, 3)
+    local_rows = entries[:, 0] - first_row
+    keep = (local_rows >= 0) & (local_rows < num_rows)
+    if not keep.all():
+        local_rows, entries = local_rows[keep], entries[keep]
+
+    order = np.argsort(local_rows, kind='stable')
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(local_rows, minlength=num_rows), out=indptr[1:])
+    indices = np.ascontiguousarray(entries[order, 1])
+    data = np.ascontiguousarray(entries[order, 2])
+    return indptr, indices, data
+
+
+def allgather_entries(comm, B, stats=None):
+    # Typed Allgatherv of every process's [k, j, b_kj] entries, instead of pickling the lists
+    local = np.asarray(B, dtype=np.int64).reshape(-1, 3)
+    counts = np.array(comm.allgather(local.size), dtype=np.int64)
+    full = np.empty(int(counts.sum()), dtype=np.int64)
+    comm.Allgatherv(np.ascontiguousarray(local).ravel(), [full, (counts, exclusive_sum(counts))])
+    if stats is not None:
+        stats['bytes_received'] = stats.get('bytes_received', 0) + full.nbytes - local.nbytes
+    return full.reshape(-1, 3)
+
+
+def fetch_b_rows(comm, needed, B, b_bounds, stats=None):
+    """
+    Communication-avoiding alternative to allgather_entries. Every process asks the owner of each
+    row k of B it needs for that row only, with two Alltoallv exchanges: one for the requested row
+    ids and one for the entries of those rows. Memory and traffic scale with what a process uses,
+    not with nnz(B).
+
+    Args:
+        needed: column indices k appearing in this process's A (duplicates are fine)
+        B: this process's rows of B as a list of [k, j, b_kj] or an (nnz x 3) array, sorted by k
+        b_bounds: process r owns rows [b_bounds[r], b_bounds[r + 1]) of B
+
+    Returns:
+        (nnz x 3) int64 array with every entry of B whose row is in needed, sorted by row
+    """
+    size = comm.Get_size()
+    local = np.asarray(B, dtype=np.int64).reshape(-1, 3)
+    b_bounds = np.asarray(b_bounds, dtype=np.int64)
+
+    # Requests: distinct rows sorted by id, which also groups them by owner
+    needed = np.unique(np.asarray(needed, dtype=np.int64))
+    owners = np.searchsorted(b_bounds, needed, side='right') - 1
+    req_counts = np.bincount(owners, minlength=size).astype(np.int64)
+    in_counts = np.empty(size, dtype=np.int64)
+    comm.Alltoall(req_counts, in_counts)
+    requested = np.empty(int(in_counts.sum()), dtype=np.int64)
+    comm.Alltoallv([needed, (req_counts, exclusive_sum(req_counts))], [requested, (in_counts, exclusive_sum(in_counts))])
+
+    # Replies: every entry of each requested row, in the order the rows were requested
+    starts = np.searchsorted(local[:, 0], requested, side='left')
+    lens = np.searchsorted(local[:, 0], requested, side='right') - starts
+    reply = np.ascontiguousarray(local[range_positions(starts, lens)]).ravel()
+    requester = np.repeat(np.arange(size), in_counts)
+    reply_counts = 3 * np.bincount(requester, weights=lens, minlength=size).astype(np.int64)
+    recv_counts = np.empty(size, dtype=np.int64)
+    comm.Alltoall(reply_counts, recv_counts)
+    fetched = np.empty(int(recv_counts.sum()), dtype=np.int64)
+    comm.Alltoallv([reply, (reply_counts, exclusive_sum(reply_counts))], [fetched, (recv_counts, exclusive_sum(recv_counts))])
+
+    if stats is not None:
+        # Rows a process owns itself are not counted, they never leave the process
+        rank = comm.Get_rank()
+        remote = requested.size - in_counts[rank] + fetched.size - recv_counts[rank]
+        stats['bytes_received'] = stats.get('bytes_received', 0) + int(remote) * fetched.itemsize
+    return fetched.reshape(-1, 3)
+
+
+def exclusive_sum(counts):
+    # Displacements for the v-variant collectives
+    displs = np.zeros_like(counts)
+    np.cumsum(counts[:-1], out=displs[1:])
+    return displs
+
+
+def csr_spgemm(m, h, n, A, B, row_range=None, b_bounds=None, stats=None, mask=None, max_output_bytes=None, shared_b=False):
+    """
+    Gustavson's algorithm on CSR matrices: row i of C is the sum over the nonzeros a_ik of
+    a_ik * (row k of B). The partial products of a batch of rows are expanded together, sorted by
+    (row, column) and summed, see gustavson.
+
+    Args:
+        A: this process's nonzeros of A as an (nnz x 3) array (or list) of [i, k, a_ik]
+        B: this process's nonzeros of B as an (nnz x 3) array (or list) of [k, j, b_kj]
+        row_range: optional (start, stop) of the rows of A owned by this process.
+                   Defaults to the smallest range covering the rows present in A.
+        b_bounds, mask: same as coo_spgemm
+        stats: same as coo_spgemm, 'busy_time' is also set to the seconds spent in the local multiply
+        max_output_bytes: optional limit on the size of this process's C. The exact size is known
+                          after the symbolic phase, and MemoryError is raised before C is allocated
+                          if it does not fit.
+        shared_b: keep one CSR copy of all of B per node in shared memory (see node_shared_csr)
+                  instead of one per process. Ignores b_bounds.
+
+    Returns:
+        (indptr, indices, data): this process's rows of C in CSR format. Row row_range[0] + r
+        has columns indices[indptr[r]:indptr[r + 1]] (sorted) and values data[indptr[r]:indptr[r + 1]].
+    """
+    comm = MPI.COMM_WORLD
+    A, B, mask, (start, stop), win = csr_operands(comm, h, A, B, row_range, b_bounds, stats, mask, shared_b)
+
+    max_nnz = None
+    if max_output_bytes is not None:
+        # indptr is fixed, every nonzero costs one index and one value
+        max_nnz = max(int((max_output_bytes - output_bytes(0, stop - start)) // (8 + np.dtype(np.int64).itemsize)), 0)
+    busy_start = MPI.Wtime()
+    try:
+        C = gustavson(A, B, n, mask=mask, max_nnz=max_nnz)
+    finally:
+        if win is not None:
+            # B lives in the window, C does not reference it
+            win.Free()
+    if stats is not None:
+        stats['busy_time'] = MPI.Wtime() - busy_start
+    return C
+
+
+def csr_operands(comm, h, A, B, row_range=None, b_bounds=None, stats=None, mask=None, shared_b=False):
+    """
+    Gets B (all of it, or only the rows this process needs) onto this process and compresses
+    this process's rows of A, B and the optional mask into CSR. stats['b_bytes'] is set to the
+    memory this process holds for B.
+
+    Returns:
+        (A, B, mask, row_range, win): A and B as (indptr, indices, data), mask as (indptr, indices)
+        or None, the row_range A was compressed with, and the shared-memory window holding B when
+        shared_b is set (None otherwise), which must be freed once B is no longer used
+    """
+    A = np.asarray(A, dtype=np.int64).reshape(-1, 3)
+
+    win = None
+    if shared_b:
+        B, win = node_shared_csr(comm, B, h, stats)
+    else:
+        if b_bounds is None:
+            fullB = allgather_entries(comm, B, stats)
+        else:
+            fullB = fetch_b_rows(comm, A[:, 1], B, b_bounds, stats)
+        B = build_csr(fullB, 0, h)
+        if stats is not None:
+            stats['b_bytes'] = sum(a.nbytes for a in B)
+
+    if row_range is None:
+        row_range = (int(A[:, 0].min()), int(A[:, 0].max()) + 1) if len(A) else (0, 0)
+    start, stop = row_range
+    if mask is not None:
+        mask = build_csr(mask, start, stop - start)[:2]
+    return build_csr(A, start, stop - start), B, mask, (start, stop), win
+
+
+def node_shared_csr(comm, B, h, stats=None):
+    """
+    All of B in CSR format, stored once per node. The processes of a node are grouped with
+    Split_type(COMM_TYPE_SHARED); the first process of each node (the leader) collects its node's
+    entries, exchanges them with the other leaders and writes the CSR arrays into a window from
+    Win.Allocate_shared. The other processes of the node map the same memory and read B in place,
+    so a node holds one copy of B instead of one per process.
+
+    Returns:
+        (B, win): B as (indptr, indices, data) views of the shared window, and the window. Freeing
+        the window (collectively) releases B.
+    """
+    local = np.ascontiguousarray(np.asarray(B, dtype=np.int64).reshape(-1, 3))
+    nnz = comm.allreduce(len(local))
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    leader = node_comm.Get_rank() == 0
+    leader_comm = comm.Split(0 if leader else MPI.UNDEFINED, comm.Get_rank())
+
+    # Entries of the node's processes to the leader, then between leaders
+    counts = node_comm.gather(local.size, root=0)
+    counts = np.array(counts, dtype=np.int64) if leader else None
+    node_part = np.empty(int(counts.sum()), dtype=np.int64) if leader else None
+    node_comm.Gatherv(local.ravel(), [node_part, (counts, exclusive_sum(counts))] if leader else None, root=0)
+
+    shared, win = shared_array(node_comm, (h + 1 + 2 * nnz,), np.int64)
+    if leader:
+        fullB = allgather_entries(leader_comm, node_part)
+        if stats is not None:
+            stats['bytes_received'] = stats.get('bytes_received', 0) + fullB.nbytes - local.nbytes
+        indptr, indices, data = build_csr(fullB, 0, h)
+        del fullB, node_part
+        shared[:h + 1] = indptr
+        shared[h + 1:h + 1 + nnz] = indices
+        shared[h + 1 + nnz:] = data
+        leader_comm.Free()
+    if stats is not None:
+        stats['b_bytes'] = shared.nbytes if leader else 0
+    # Nobody reads B before the leader has written it
+    node_comm.Barrier()
+    node_comm.Free()
+    return (shared[:h + 1], shared[h + 1:h + 1 + nnz], shared[h + 1 + nnz:]), win
+
+
+def stream_spgemm(m, h, n, A, B, path, memory_budget, row_range=None, b_bounds=None, stats=None, mask=None):
+    """
+    Out-of-core variant of csr_spgemm for products too large to hold. The symbolic phase gives the
+    exact size of every row of C, which is used to cut this process's rows into batches whose output
+    and expansion temporaries (PRODUCT_BYTES per partial product) fit in memory_budget bytes. Both
+    phases expand at most memory_budget / PRODUCT_BYTES partial products at a time. Each batch is
+    computed with the numeric phase, written to path and dropped before the next one starts, so only
+    one batch of C is ever in memory. The budget covers this working memory, not the inputs: this
+    process's rows of A and the B it holds (all of it, or only the rows it needs with b_bounds).
+
+    All processes write to one shared file with MPI-IO. It holds the nonzeros of C as consecutive
+    int64 triples [i, j, c_ij] sorted by (i, j), i.e. np.fromfile(path, dtype=np.int64).reshape(-1, 3).
+    Every process knows its own nnz after the symbolic phase, and an exclusive scan over them gives
+    each process the offset of its rows in the file.
+
+    Args:
+        path: output file, created or overwritten
+        memory_budget: bytes a batch may use for its CSR result, the triples written out and the
+                       expanded partial products. A single row larger than the budget still gets a
+                       batch of its own.
+        row_range, b_bounds, stats, mask: same as csr_spgemm
+
+    Returns:
+        (nnz, num_batches, largest_batch): nonzeros this process wrote, the number of batches and
+        the size in bytes of the largest batch
+    """
+    comm = MPI.COMM_WORLD
+    A, B, mask, (start, stop), _ = csr_operands(comm, h, A, B, row_range, b_bounds, stats, mask)
+    batch_products = max(memory_budget // PRODUCT_BYTES, 1)
+    row_nnz = gustavson_symbolic(A, B, n, mask, batch_products)
+    row_bytes = batch_bytes(row_nnz, row_cost(A, B, mask))
+    batches = cut_batches(row_bytes, memory_budget)
+
+    nnz = int(row_nnz.sum())
+    offset = comm.exscan(nnz)
+    offset = 0 if offset is None else offset
+    triple = 3 * np.dtype(np.int64).itemsize
+
+    largest_batch = 0
+    fh = MPI.File.Open(comm, path, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+    fh.Set_size(0)
+    for lo, hi in zip(batches[:-1], batches[1:]):
+        C_indptr, C_indices, C_data = gustavson(slice_rows(A, lo, hi), B, n,
+                                                slice_rows(mask, lo, hi) if mask is not None else None,
+                                                row_nnz=row_nnz[lo:hi], batch_products=batch_products)
+        out = np.empty((len(C_indices), 3), dtype=np.int64)
+        out[:, 0] = np.repeat(np.arange(start + lo, start + hi), np.diff(C_indptr))
+        out[:, 1] = C_indices
+        out[:, 2] = C_data
+        fh.Write_at(offset * triple, out)
+        offset += len(out)
+        largest_batch = max(largest_batch, int(row_bytes[lo:hi].sum()))
+        del C_indptr, C_indices, C_data, out
+    fh.Close()
+    return nnz, len(batches) - 1, largest_batch
+
+
+def batch_bytes(row_nnz, row_products):
+    # Memory of every row in a stream_spgemm batch: one indptr entry, an index, a value and a written
+    # triple per nonzero, and the temporaries of its expanded partial products
+    return 8 + row_nnz * (16 + 3 * 8) + row_products * PRODUCT_BYTES
+
+
+def cut_batches(row_cost, budget):
+    # Contiguous batches of rows whose total cost stays within budget, a row costing more gets a batch of its own
+    cost = np.zeros(len(row_cost) + 1, dtype=np.int64)
+    np.cumsum(row_cost, out=cost[1:])
+    bounds = [0]
+    while bounds[-1] < len(row_cost):
+        lo = bounds[-1]
+        hi = int(np.searchsorted(cost, cost[lo] + budget, side='right')) - 1
+        bounds.append(max(hi, lo + 1))
+    return np.array(bounds, dtype=np.int64)
+
+
+def slice_rows(csr, lo, hi):
+    # Rows lo ... hi - 1 of a CSR matrix (or an (indptr, indices) pattern) without copying indices/data
+    indptr = csr[0][lo:hi + 1]
+    return (indptr - indptr[0],) + tuple(a[indptr[0]:indptr[-1]] for a in csr[1:])
+
+
+def dynamic_spgemm(m, h, n, A, B, chunk_size=64, stats=None):
+    """
+    Gustavson SpGEMM with dynamic scheduling instead of a fixed row partition. A shared counter
+    in an MPI one-sided window on rank 0 holds the next row to be computed; every process
+    atomically takes the next chunk_size rows with Fetch_and_op, computes them and asks again
+    until the counter passes m. Processes that get cheap rows simply take more chunks, so a few
+    heavy rows no longer decide the runtime.
+
+    Every process can be handed any row, so A and B are both gathered onto every process first.
+
+    Args:
+        A: this process's nonzeros of A as an (nnz x 3) array (or list) of [i, k, a_ik], any distribution
+        B: this process's nonzeros of B as an (nnz x 3) array (or list) of [k, j, b_kj], any distribution
+        chunk_size: rows handed out per request, at least 1 (0 would never move the counter)
+        stats: optional dict, 'bytes_received' is increased by the bytes received for A and B,
+               'busy_time' is set to the seconds spent computing chunks and 'chunks' to their number
+
+    Returns:
+        C: nonzeros of the rows of C this process computed as an (nnz x 3) int64 array of
+           [i, j, c_ij], sorted by (i, j). The rows are not contiguous.
+    """
+    assert chunk_size >= 1
+    comm = MPI.COMM_WORLD
+    A = build_csr(allgather_entries(comm, A, stats), 0, m)
+    B = build_csr(allgather_entries(comm, B, stats), 0, h)
+
+    # MPI allocates the counter itself (one int64 on rank 0, nothing elsewhere) and it is zeroed
+    # with a Put before anyone takes a chunk
+    win = MPI.Win.Allocate(8 if comm.Get_rank() == 0 else 0, 8, comm=comm)
+    if comm.Get_rank() == 0:
+        win.Lock(0, MPI.LOCK_EXCLUSIVE)
+        win.Put(np.zeros(1, dtype=np.int64), 0, 0)
+        win.Unlock(0)
+    comm.Barrier()
+    step = np.array([chunk_size], dtype=np.int64)
+    first = np.empty(1, dtype=np.int64)
+
+    parts = []
+    busy = 0.0
+    while True:
+        win.Lock(0, MPI.LOCK_SHARED)
+        win.Fetch_and_op(step, first, 0, 0, MPI.SUM)
+        win.Unlock(0)
+        lo = int(first[0])
+        if lo >= m:
+            break
+        hi = min(lo + chunk_size, m)
+
+        start = MPI.Wtime()
+        C_indptr, C_indices, C_data = gustavson(slice_rows(A, lo, hi), B, n)
+        parts.append(np.column_stack((np.repeat(np.arange(lo, hi), np.diff(C_indptr)), C_indices, C_data)))
+        busy += MPI.Wtime() - start
+    win.Free()
+
+    if stats is not None:
+        stats['busy_time'] = busy
+        stats['chunks'] = len(parts)
+    # The counter only grows, so this process's chunks are already in row order
+    return np.concatenate(parts) if parts else np.empty((0, 3), dtype=np.int64)
+
+
+# Partial products expanded at once by the CSR kernel, a batch of rows holds about this many
+BATCH_PRODUCTS = 1 << 20
+# Peak bytes of temporaries per expanded partial product (offsets, keys, products and the sort in sum_duplicates)
+PRODUCT_BYTES = 64
+# A b_kj lookup (a binary search over B) costs about this many expanded partial products
+LOOKUP_COST = 4
+
+
+def range_positions(starts, lens):
+    # Concatenation of range(starts[r], starts[r] + lens[r]) for every r, without a python loop
+    return np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(int(lens.sum()))
+
+
+def row_flops(A, B):
+    # Number of partial products a_ik * b_kj of every row of A * B
+    A_indptr, A_indices, _ = A
+    per_entry = np.zeros(len(A_indices) + 1, dtype=np.int64)
+    np.cumsum(np.diff(B[0])[A_indices], out=per_entry[1:])
+    return per_entry[A_indptr[1:]] - per_entry[A_indptr[:-1]]
+
+
+def row_cost(A, B, mask=None):
+    # Partial products (or dot product lookups, see masked_row_cost) of every row, what batches are cut by
+    flops = row_flops(A, B)
+    return flops if mask is None else masked_row_cost(A, mask, flops)[0]
+
+
+def batch_mask_keys(mask, lo, hi, n):
+    # Sorted keys (r - lo) * n + j of the mask entries of rows lo ... hi - 1
+    mask_indptr, mask_indices = mask
+    rows = np.repeat(np.arange(hi - lo), np.diff(mask_indptr[lo:hi + 1]))
+    return np.sort(rows * n + mask_indices[mask_indptr[lo]:mask_indptr[hi]])
+
+
+def sorted_b_keys(B, n):
+    # Keys k * n + j of all nonzeros of B in ascending order, and the position in B's indices/data of each
+    B_indptr, B_indices, _ = B
+    keys = np.repeat(np.arange(len(B_indptr) - 1), np.diff(B_indptr)) * n + B_indices
+    order = np.argsort(keys, kind='stable')
+    return keys[order], order
+
+
+def masked_row_cost(A, mask, flops):
+    """
+    Work of every row of A * B restricted to mask. A row is either expanded (its flops, see row_flops)
+    or, when that is cheaper, every masked c_ij is computed as a dot product by looking up b_kj for
+    each a_ik of the row (nnz of the mask row times nnz of the A row lookups, LOOKUP_COST each).
+
+    Returns:
+        (cost, dot): the work of every row, and whether it is computed with dot products
+    """
+    lookups = np.diff(mask[0]) * np.diff(A[0])
+    dot = lookups * LOOKUP_COST < flops
+    return np.where(dot, lookups, flops), dot
+
+
+def expand_products(A, B, lo, hi, n, mask=None, values=True, b_keys=None):
+    """
+    Expands every partial product a_ik * b_kj of rows lo ... hi - 1 of A * B at once, with duplicates.
+
+    With a mask, only products at masked positions are returned. Rows where that is cheaper
+    (see masked_row_cost) are not expanded: for every masked (i, j) and every a_ik of row i,
+    b_kj is looked up in b_keys (sorted_b_keys of B), so the work is bounded by the mask.
+    The other rows are expanded and their products outside the mask are dropped.
+
+    Returns:
+        (keys, products): the key (r - lo) * n + j of each partial product and its value (None if values is False)
+    """
+    A_indptr, A_indices, A_data = A
+    B_indptr, B_indices, B_data = B
+    a_lo, a_hi = A_indptr[lo], A_indptr[hi]
+    ks = A_indices[a_lo:a_hi]
+    # Row (within the batch) of every nonzero of A
+    a_rows = np.repeat(np.arange(hi - lo), np.diff(A_indptr[lo:hi + 1]))
+    lens = B_indptr[ks + 1] - B_indptr[ks]
+    if mask is not None:
+        mask_keys = batch_mask_keys(mask, lo, hi, n)
+        # Duplicated mask entries must not be counted twice by the dot products
+        mask_keys = mask_keys[np.concatenate(([True], mask_keys[1:] != mask_keys[:-1]))] if len(mask_keys) else mask_keys
+        flops = np.bincount(a_rows, weights=lens, minlength=hi - lo)
+        _, dot = masked_row_cost(slice_rows(A, lo, hi), slice_rows(mask, lo, hi), flops)
+        lens = lens * ~dot[a_rows]
+
+    # Positions in B_indices/B_data of every b_kj for the k's in the expanded rows
+    offsets = range_positions(B_indptr[ks], lens)
+    keys = np.repeat(a_rows, lens) * n + B_indices[offsets]
+    products = B_data[offsets] * np.repeat(A_data[a_lo:a_hi], lens) if values else None
+    if mask is None:
+        return keys, products
+    if len(keys):
+        keep = in_sorted(mask_keys, keys)
+        keys = keys[keep]
+        if values:
+            products = products[keep]
+
+    # Dot products: every masked (r, j) of a dot row paired with every a_ik of row r
+    mask_keys = mask_keys[dot[mask_keys // n]]
+    mask_rows = mask_keys // n
+    a_nnz = np.diff(A_indptr[lo:hi + 1])[mask_rows]
+    a_pos = range_positions(A_indptr[lo + mask_rows], a_nnz)
+    pair_keys = np.repeat(mask_keys, a_nnz)
+    queries = A_indices[a_pos] * n + pair_keys % n
+    # All b_kj with that key (more than one if B has duplicates, none if b_kj = 0)
+    sorted_keys, order = b_keys
+    first = np.searchsorted(sorted_keys, queries, side='left')
+    found = np.searchsorted(sorted_keys, queries, side='right') - first
+    b_pos = order[range_positions(first, found)]
+    keys = np.concatenate((keys, np.repeat(pair_keys, found)))
+    if values:
+        products = np.concatenate((products, B_data[b_pos] * np.repeat(A_data[a_pos], found)))
+    return keys, products
+
+
+def in_sorted(sorted_keys, keys):
+    # keys[t] in sorted_keys for every t, with one binary search each
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    pos = np.searchsorted(sorted_keys, keys)
+    pos[pos == len(sorted_keys)] = 0
+    return sorted_keys[pos] == keys
+
+
+def sum_duplicates(keys, products):
+    # Sorts partial products by key and adds up those with the same key: (distinct sorted keys, sums)
+    if len(keys) == 0:
+        return keys, products
+    order = np.argsort(keys)
+    keys = keys[order]
+    first = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[first], np.add.reduceat(products[order], first)
+
+
+def gustavson_symbolic(A, B, n, mask=None, batch_products=BATCH_PRODUCTS):
+    """
+    Symbolic phase of Gustavson's algorithm: the exact number of nonzeros of every row of A * B
+    (restricted to mask if given), without computing any value. Rows are handled in batches of
+    about batch_products partial products, see gustavson.
+    """
+    num_rows = len(A[0]) - 1
+    row_nnz = np.zeros(num_rows, dtype=np.int64)
+    if n == 0:
+        return row_nnz
+    batches = cut_batches(row_cost(A, B, mask), batch_products)
+    b_keys = sorted_b_keys(B, n) if mask is not None else None
+    for lo, hi in zip(batches[:-1], batches[1:]):
+        keys, _ = expand_products(A, B, lo, hi, n, mask, values=False, b_keys=b_keys)
+        # Distinct keys as in sum_duplicates: sort, then keep the first of every run
+        keys = np.sort(keys)
+        first = np.concatenate(([True], keys[1:] != keys[:-1])) if len(keys) else np.zeros(0, dtype=bool)
+        row_nnz[lo:hi] = np.bincount(keys[first] // n, minlength=hi - lo)
+    return row_nnz
+
+
+def gustavson(A, B, n, mask=None, max_nnz=None, row_nnz=None, batch_products=BATCH_PRODUCTS):
+    """
+    Local Gustavson SpGEMM of two CSR matrices given as (indptr, indices, data) tuples.
+
+    Rows are not accumulated one at a time, the per-row NumPy calls cost more than the work on sparse
+    rows. Instead, all partial products of a batch of rows (about batch_products of them) are expanded
+    at once, keyed by r * n + j, sorted, and equal keys are summed with np.add.reduceat. The sorted keys
+    are C's rows and columns in order, so one expansion gives both the nonzero count of every row
+    (symbolic phase) and the values (numeric phase), and the batches are simply concatenated.
+
+    When the size of C must be known before it is allocated (max_nnz is given), the symbolic phase
+    (gustavson_symbolic) runs over all rows first; a prefix sum gives C's indptr, indices/data are
+    allocated once at their exact size and the numeric phase fills them in place. That expands
+    every batch twice, so it is only done when the limit is asked for. row_nnz skips the symbolic
+    phase when its result is already known (see stream_spgemm).
+
+    mask is an optional (indptr, indices) pattern with the same rows as A. With a mask, every row is
+    computed the cheaper way (see masked_row_cost): rows whose masked entries take fewer lookups than
+    the row has partial products get one dot product per masked c_ij, so their work is bounded by the
+    mask; the other rows are expanded and their products outside the mask are dropped before they are
+    sorted. The output is bounded by nnz(mask) either way.
+
+    Raises:
+        MemoryError: if C would have more than max_nnz nonzeros. Nothing has been allocated for C then.
+
+    Returns:
+        (indptr, indices, data) of C, with sorted column indices in every row
+    """
+    num_rows = len(A[0]) - 1
+    dtype = np.result_type(A[2], B[2])
+    C_indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    if n == 0:
+        return C_indptr, np.empty(0, dtype=np.int64), np.empty(0, dtype=dtype)
+    batches = cut_batches(row_cost(A, B, mask), batch_products)
+    b_keys = sorted_b_keys(B, n) if mask is not None else None
+
+    if row_nnz is None and max_nnz is None:
+        # One pass: every batch is expanded once and its sorted keys give both counts and columns
+        indices, data = [], []
+        for lo, hi in zip(batches[:-1], batches[1:]):
+            keys, products = sum_duplicates(*expand_products(A, B, lo, hi, n, mask, b_keys=b_keys))
+            C_indptr[lo + 1:hi + 1] = np.bincount(keys // n, minlength=hi - lo)
+            indices.append(keys % n)
+            data.append(products.astype(dtype, copy=False))
+        np.cumsum(C_indptr, out=C_indptr)
+        C_indices = np.concatenate(indices) if indices else np.empty(0, dtype=np.int64)
+        C_data = np.concatenate(data) if data else np.empty(0, dtype=dtype)
+        return C_indptr, C_indices, C_data
+
+    if row_nnz is None:
+        row_nnz = gustavson_symbolic(A, B, n, mask)
+    np.cumsum(row_nnz, out=C_indptr[1:])
+    total = int(C_indptr[-1])
+    if max_nnz is not None and total > max_nnz:
+        raise MemoryError(f"Output would have {total} nonzeros ({output_bytes(total, num_rows, dtype) / 1e6:0.1f} MB), "
+                          f"more than the limit of {max_nnz}")
+    C_indices = np.empty(total, dtype=np.int64)
+    C_data = np.empty(total, dtype=dtype)
+    if total == 0:
+        return C_indptr, C_indices, C_data
+
+    for lo, hi in zip(batches[:-1], batches[1:]):
+        keys, products = sum_duplicates(*expand_products(A, B, lo, hi, n, mask, b_keys=b_keys))
+        C_indices[C_indptr[lo]:C_indptr[hi]] = keys % n
+        C_data[C_indptr[lo]:C_indptr[hi]] = products
+
+    return C_indptr, C_indices, C_data
+
+
+def output_bytes(nnz, num_rows, dtype=np.int64):
+    # Size of a CSR matrix with int64 indptr/indices
+    return (num_rows + 1) * 8 + nnz * (8 + np.dtype(dtype).itemsize)
+
+
+def exchange_entries(comm, entries, owners):
+    # Sends every [i, j, w] row of entries to the process in owners with one typed Alltoallv
+    size = comm.Get_size()
+    order = np.argsort(owners, kind='stable')
+    send_counts = 3 * np.bincount(owners, minlength=size).astype(np.int64)
+    recv_counts = np.empty(size, dtype=np.int64)
+    comm.Alltoall(send_counts, recv_counts)
+    received = np.empty(int(recv_counts.sum()), dtype=np.int64)
+    comm.Alltoallv([np.ascontiguousarray(entries[order]).ravel(), (send_counts, exclusive_sum(send_counts))],
+                   [received, (recv_counts, exclusive_sum(recv_counts))])
+    return received.reshape(-1, 3)
+
+
+def row_owners(comm, row_range, rows):
+    # Rank in comm of the process whose row_range holds each of rows
+    ranges = np.array(comm.allgather(row_range), dtype=np.int64).reshape(-1, 2)
+    # Sorting by (start, stop) makes the non-empty range win when an empty one has the same start
+    order = np.lexsort((ranges[:, 1], ranges[:, 0]))
+    return order[np.searchsorted(ranges[order, 0], rows, side='right') - 1]
+
+
+def bcast_csr(comm, csr, num_rows, root):
+    # Broadcasts a CSR block whose number of rows every process already knows
+    is_root = comm.Get_rank() == root
+    nnz = np.array([len(csr[1]) if is_root else 0], dtype=np.int64)
+    comm.Bcast(nnz, root=root)
+    if is_root:
+        indptr, indices, data = csr
+    else:
+        indptr = np.empty(num_rows + 1, dtype=np.int64)
+        indices = np.empty(int(nnz[0]), dtype=np.int64)
+        data = np.empty(int(nnz[0]), dtype=np.int64)
+    comm.Bcast(indptr, root=root)
+    comm.Bcast(indices, root=root)
+    comm.Bcast(data, root=root)
+    return indptr, indices, data
+
+
+def spsumma_spgemm(m, h, n, A, B, row_range=None, stats=None):
+    """
+    2D Sparse SUMMA on a pr x pc process grid (MPI.Compute_dims, as summa_matrix_multiply). Process (i, j)
+    owns block (i, j) of C, the columns of A block row i that fall in column block j of the inner
+    dimension and the rows of B block column j that fall in its row block i, all stored as local CSR.
+    The inner dimension is cut at the block edges of both splits into panels; in every stage the owner
+    of the panel broadcasts its columns of A along grid row i and its rows of B along grid column j,
+    every process multiplies the two panels it received and the partial products of all stages are
+    merged at the end. No process ever holds more than a few panels, so memory per process is O(nnz / p).
+
+    Takes and returns the same 1D row distribution as coo_spgemm, so it can replace it directly:
+    the nonzeros are moved to their 2D blocks at the start and the rows of C back at the end.
+
+    Args:
+        A: this process's nonzeros of A as an (nnz x 3) array (or list) of [i, k, a_ik]
+        B: this process's nonzeros of B as an (nnz x 3) array (or list) of [k, j, b_kj]
+        row_range: (start, stop) of the rows of C this process returns. Defaults to an even split.
+        stats: optional dict, 'bytes_received' is increased by the bytes received in the broadcasts
+
+    Returns:
+        C: nonzeros of rows start <= i < stop of C as an (nnz x 3) int64 array of [i, j, c_ij], sorted by (i, j)
+    """
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    pr, pc = MPI.Compute_dims(size, [0, 0])
+
+    # Same grid and row/column subcommunicators as blocked_matrix_multiply
+    comm_cart = comm.Create_cart([pr, pc], periods=[1, 1], reorder=True)
+    cart_rank = comm_cart.Get_rank()
+    coords = comm_cart.Get_coords(cart_rank)
+    row_comm = comm_cart.Split(color=coords[0], key=coords[1])
+    col_comm = comm_cart.Split(color=coords[1], key=coords[0])
+
+    # The inner index k is split into pc blocks of columns of A, but into pr blocks of rows of B
+    m_bounds, n_bounds = block_bounds(m, pr), block_bounds(n, pc)
+    hA_bounds, hB_bounds = block_bounds(h, pc), block_bounds(h, pr)
+    grid_ranks = np.array([[comm_cart.Get_cart_rank((i, j)) for j in range(pc)] for i in range(pr)])
+
+    def block_of(bounds, idx):
+        return np.searchsorted(bounds, idx, side='right') - 1
+
+    # Move every nonzero of A and B to the process owning its 2D block
+    A = np.asarray(A, dtype=np.int64).reshape(-1, 3)
+    B = np.asarray(B, dtype=np.int64).reshape(-1, 3)
+    A_block = exchange_entries(comm_cart, A, grid_ranks[block_of(m_bounds, A[:, 0]), block_of(hA_bounds, A[:, 1])])
+    B_block = exchange_entries(comm_cart, B, grid_ranks[block_of(hB_bounds, B[:, 0]), block_of(n_bounds, B[:, 1])])
+
+    bi, bj = coords
+    block_rows = m_bounds[bi + 1] - m_bounds[bi]
+    block_cols = n_bounds[bj + 1] - n_bounds[bj]
+    B_block[:, 1] -= n_bounds[bj]
+
+    # A panel must not cross a block edge of either split, so it lies inside one block of each
+    edges = np.union1d(hA_bounds, hB_bounds)
+    panels = [(lo, hi) for lo, hi in zip(edges[:-1], edges[1:]) if hi > lo]
+
+    def panel_csr(entries, col, first_row, num_rows, lo, hi):
+        # CSR of the entries whose index in column col lies in [lo, hi), with that index made relative to lo
+        panel = entries[(entries[:, col] >= lo) & (entries[:, col] < hi)].copy()
+        panel[:, col] -= lo
+        return build_csr(panel, first_row, num_rows)
+
+    partial_rows, partial_cols, partial_vals = [], [], []
+    received = 0
+    for lo, hi in panels:
+        owner_col, owner_row = block_of(hA_bounds, lo), block_of(hB_bounds, lo)
+        A_panel = panel_csr(A_block, 1, m_bounds[bi], block_rows, lo, hi) if bj == owner_col else None
+        B_panel = panel_csr(B_block, 0, 0, hi - lo, lo, hi) if bi == owner_row else None
+        stage_A = bcast_csr(row_comm, A_panel, block_rows, root=owner_col)
+        stage_B = bcast_csr(col_comm, B_panel, hi - lo, root=owner_row)
+        if bj != owner_col:
+            received += sum(arr.nbytes for arr in stage_A)
+        if bi != owner_row:
+            received += sum(arr.nbytes for arr in stage_B)
+
+        indptr, indices, data = gustavson(stage_A, stage_B, block_cols)
+        partial_rows.append(np.repeat(np.arange(block_rows), np.diff(indptr)))
+        partial_cols.append(indices)
+        partial_vals.append(data)
+
+    if stats is not None:
+        stats['bytes_received'] = stats.get('bytes_received', 0) + received
+
+    # Merge the stages: entries with the same (row, col) are summed
+    keys = np.concatenate(partial_rows) * block_cols + np.concatenate(partial_cols)
+    keys, vals = sum_duplicates(keys, np.concatenate(partial_vals))
+    C_block = np.column_stack((keys // block_cols + m_bounds[bi], keys % block_cols + n_bounds[bj], vals)) if block_cols else np.empty((0, 3), dtype=np.int64)
+
+    # Send every row of C back to the process whose row_range holds it
+    if row_range is None:
+        bounds = block_bounds(m, size)
+        row_range = (int(bounds[rank]), int(bounds[rank + 1]))
+    C_rows = exchange_entries(comm_cart, C_block, row_owners(comm_cart, row_range, C_block[:, 0]))
+
+    row_comm.Free()
+    col_comm.Free()
+    comm_cart.Free()
+    return C_rows[np.lexsort((C_rows[:, 1], C_rows[:, 0]))]
+
+
+def gram_spgemm(m, h, A, row_range=None, mirror=True, stats=None):
+    """
+    C = A * A^T without a separately built transpose. C is symmetric and c_ij = sum_k a_ik * a_jk
+    (the number of shared neighbors of i and j for 0/1 adjacency), so only the upper triangle
+    j >= i is computed: for every a_ik, only the part of column k of A with rows j >= i is visited.
+    The strictly upper entries are then mirrored to the process owning row j.
+
+    Args:
+        A: this process's nonzeros of A (m x h) as an (nnz x 3) array (or list) of [i, k, a_ik]
+        row_range: optional (start, stop) of the rows of A owned by this process.
+                   Defaults to the smallest range covering the rows present in A.
+        mirror: if False, return only the upper triangle (j >= i) of this process's rows
+        stats: optional dict, 'bytes_received' is increased by the bytes received for A and
+               'busy_time' is set to the seconds spent computing the upper triangle and mirroring it
+
+    Returns:
+        C: nonzeros of this process's rows of C as an (nnz x 3) int64 array of [i, j, c_ij], sorted by (i, j)
+    """
+    comm = MPI.COMM_WORLD
+    A = np.asarray(A, dtype=np.int64).reshape(-1, 3)
+
+    # Columns of A with their rows in ascending order. Column k of A is row k of A^T,
+    # so this is A^T in CSR without building the transpose as a separate input.
+    fullA = allgather_entries(comm, A, stats)
+    order = np.lexsort((fullA[:, 0], fullA[:, 1]))
+    fullA = fullA[order]
+    col_indptr = np.zeros(h + 1, dtype=np.int64)
+    np.cumsum(np.bincount(fullA[:, 1], minlength=h), out=col_indptr[1:])
+    col_rows = np.ascontiguousarray(fullA[:, 0])
+    col_vals = np.ascontiguousarray(fullA[:, 2])
+    # Where every gathered entry ended up in column order (the first of its copies if it is duplicated)
+    new = np.ones(len(fullA), dtype=bool)
+    new[1:] = (fullA[1:, 0] != fullA[:-1, 0]) | (fullA[1:, 1] != fullA[:-1, 1])
+    col_position = np.empty(len(fullA), dtype=np.int64)
+    col_position[order] = np.maximum.accumulate(np.where(new, np.arange(len(fullA)), 0))
+    # This process's entries start here in the gathered array
+    offset = comm.exscan(len(A)) or 0
+
+    if row_range is None:
+        row_range = (int(A[:, 0].min()), int(A[:, 0].max()) + 1) if len(A) else (0, 0)
+    start, stop = row_range
+    # CSR of this process's rows holding the number of every entry instead of its value
+    A_indptr, A_indices, entry = build_csr(np.column_stack((A[:, :2], np.arange(len(A)))), start, stop - start)
+    A_data = A[entry, 2]
+
+    busy_start = MPI.Wtime()
+    # a_ik is the entry (k, i) of column k and the rows below it are j >= i, so only the part of
+    # column k from a_ik's own position on is visited. No search is needed.
+    first = col_position[offset + entry]
+    lens = col_indptr[A_indices + 1] - first
+    # Rows in batches of about BATCH_PRODUCTS partial products, as in gustavson
+    per_entry = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(lens, out=per_entry[1:])
+    batches = cut_batches(per_entry[A_indptr[1:]] - per_entry[A_indptr[:-1]], BATCH_PRODUCTS)
+    # The upper triangle is kept as sorted keys i * m + j and their values until C is assembled
+    upper_keys, upper_vals = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for lo, hi in zip(batches[:-1], batches[1:]):
+        a_lo, a_hi = A_indptr[lo], A_indptr[hi]
+        a_rows = np.repeat(np.arange(hi - lo), np.diff(A_indptr[lo:hi + 1]))
+        batch_lens = lens[a_lo:a_hi]
+        offsets = range_positions(first[a_lo:a_hi], batch_lens)
+        keys = np.repeat(a_rows, batch_lens) * m + col_rows[offsets]
+        keys, sums = sum_duplicates(keys, col_vals[offsets] * np.repeat(A_data[a_lo:a_hi], batch_lens))
+        upper_keys.append(keys + (start + lo) * m)
+        upper_vals.append(sums)
+    keys, vals = np.concatenate(upper_keys), np.concatenate(upper_vals)
+
+    if mirror:
+        # c_ji = c_ij: send the strictly upper entries, transposed, to the owner of row j
+        rows, cols = keys // m, keys % m
+        strict = cols > rows
+        lower = np.column_stack((cols[strict], rows[strict], vals[strict]))
+        received = exchange_entries(comm, lower, row_owners(comm, row_range, lower[:, 0]))
+        keys, vals = merge_sorted(keys, vals, received[:, 0] * m + received[:, 1], received[:, 2])
+    C = np.column_stack((keys // m, keys % m, vals))
+    if stats is not None:
+        stats['busy_time'] = MPI.Wtime() - busy_start
+    return C
+
+
+def merge_sorted(keys, vals, other_keys, other_vals):
+    """
+    Merges sorted keys (and their values) with other_keys in any order: only other_keys are sorted,
+    then every entry of both is written straight to its place in the result. The keys are distinct.
+
+    Returns:
+        (keys, vals): all keys in ascending order and their values
+    """
+    order = np.argsort(other_keys)
+    other_keys, other_vals = other_keys[order], other_vals[order]
+    # Place of an entry = its place in its own array + the entries of the other array before it
+    pos = np.arange(len(keys)) + np.searchsorted(other_keys, keys)
+    other_pos = np.arange(len(other_keys)) + np.searchsorted(keys, other_keys)
+    merged_keys = np.empty(len(keys) + len(other_keys), dtype=np.int64)
+    merged_vals = np.empty(len(merged_keys), dtype=np.result_type(vals, other_vals))
+    merged_keys[pos], merged_vals[pos] = keys, vals
+    merged_keys[other_pos], merged_vals[other_pos] = other_keys, other_vals
+    return merged_keys, merged_vals